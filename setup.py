@@ -31,6 +31,7 @@ setup(
 	download_url     =  WEBSITE + "/%s-%s.tar.gz" % (NAME.lower(), VERSION) ,
 	keywords         = ["css", "pre-processor", "clever css",],
 	install_requires = ["libparsing",],
+	extras_require   = {"numpy":["numpy"]},
 	packages         = ["pythoniccss"],
 	package_dir      = {"pythoniccss":"src/pythoniccss"},
 	package_data     = {"pythoniccss":["rgb.txt"]},
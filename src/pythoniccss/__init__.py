@@ -9,7 +9,7 @@
 # Last modification : 21-Nov-2016
 # -----------------------------------------------------------------------------
 
-from .command   import run, parse, parseString, processResult
+from .command   import run, parse, parseString, processResult, stream
 
 VERSION    = "0.7.0"
 LICENSE    = "http://ffctn.com/doc/licenses/bsd"
@@ -0,0 +1,126 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import os, gzip, hashlib, tempfile
+from   typing import Optional
+
+__doc__ = """
+Output files for the compiled CSS. An `Artifact` is a binary output that
+writes the CSS to a temporary file while computing its digest and, when
+a compression level is given, compressing it to a temporary `.gz` file,
+so that the CSS is only held once in memory. The artifact is then
+committed to its final path, unless the existing file has the same digest.
+"""
+
+# The size of the blocks read when computing the digest of a file
+BLOCK_SIZE = 64 * 1024
+
+def getDigest( path:str ) -> Optional[str]:
+	"""Returns the SHA-256 digest of the file at the given path, or `None`
+	if it does not exist."""
+	if not os.path.exists(path):
+		return None
+	digest = hashlib.sha256()
+	with open(path, "rb") as f:
+		while True:
+			data = f.read(BLOCK_SIZE)
+			if not data:
+				break
+			digest.update(data)
+	return digest.hexdigest()
+
+def getFileMode() -> int:
+	"""Returns the mode of the files created with the current umask."""
+	umask = os.umask(0)
+	os.umask(umask)
+	return 0o666 & ~umask
+
+# -----------------------------------------------------------------------------
+#
+# ARTIFACT
+#
+# -----------------------------------------------------------------------------
+
+class Artifact:
+	"""A binary output written to temporary files in the given directory,
+	and compressed at the given gzip `level` (1-9) if any. The gzip
+	timestamp is zero, so that the same CSS gives the same `.gz`."""
+
+	def __init__( self, directory:str=".", level:Optional[int]=None ):
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		self.level      = level
+		self.size       = 0
+		self.compressed = 0
+		self._digest    = hashlib.sha256()
+		self._file      = tempfile.NamedTemporaryFile(dir=directory or ".", suffix=".css.tmp", delete=False)
+		self._gzFile    = tempfile.NamedTemporaryFile(dir=directory or ".", suffix=".css.gz.tmp", delete=False) if level else None
+		self._gzip      = gzip.GzipFile(filename="", mode="wb", compresslevel=level, fileobj=self._gzFile, mtime=0) if level else None
+		self.isClosed   = False
+
+	@property
+	def digest( self ) -> str:
+		return self._digest.hexdigest()
+
+	@property
+	def ratio( self ) -> float:
+		"""The size of the compressed output relative to the CSS."""
+		return float(self.compressed) / self.size if self.size else 1.0
+
+	def write( self, data:bytes ):
+		self._file.write(data)
+		self._digest.update(data)
+		self.size += len(data)
+		if self._gzip:
+			self._gzip.write(data)
+		return len(data)
+
+	def flush( self ):
+		self._file.flush()
+
+	def close( self ):
+		"""Closes the temporary files, which is done by `commit` and
+		`discard`."""
+		if self.isClosed:
+			return
+		self.isClosed = True
+		self._file.close()
+		if self._gzip:
+			self._gzip.close()
+			self.compressed = self._gzFile.tell()
+			self._gzFile.close()
+
+	def commit( self, path:str ) -> bool:
+		"""Moves the artifact to the given path (and `path + ".gz"`), unless
+		the file at that path has the same digest, in which case the
+		temporary files are removed. Returns `True` when the file was
+		written."""
+		self.close()
+		if getDigest(path) == self.digest and (not self._gzip or os.path.exists(path + ".gz")):
+			self.discard()
+			return False
+		directory = os.path.dirname(path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		# NOTE: Temporary files are only readable by their owner, we give
+		# them the permissions of a regular file.
+		mode = getFileMode()
+		os.chmod(self._file.name, mode)
+		os.replace(self._file.name, path)
+		if self._gzip:
+			os.chmod(self._gzFile.name, mode)
+			os.replace(self._gzFile.name, path + ".gz")
+		return True
+
+	def discard( self ):
+		"""Removes the temporary files."""
+		self.close()
+		for _ in (self._file, self._gzFile):
+			if _ and os.path.exists(_.name):
+				os.unlink(_.name)
+
+# EOF - vim: ts=4 sw=4 noet
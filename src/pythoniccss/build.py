@@ -0,0 +1,207 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import os, json
+from   typing     import Dict,List,Optional
+from  .cache      import Graph
+from  .writer     import CSSWriter
+from  .artifacts  import Artifact
+from  .manifest   import BUILD_MANIFEST, getInputs, isEntryFor, isFreshEntry, load
+from  .model      import ImportDirective, UseDirective, SemanticError
+
+__doc__ = """
+Compiles a set of PCSS files to a directory, optionally writing each output
+as `NAME.<HASH>.css`, where the hash is the digest of the CSS, so that an
+unchanged output keeps its name (and its CDN cache entries) across deploys.
+A `manifest.json` maps each source to its output, digest and dependencies.
+Outputs whose digest did not change are not rewritten, and each output can
+have a precompressed `.css.gz` next to it.
+
+The manifest also records the options of the build and the modification
+time and size of the files each output depends on, so that the outputs
+that are up to date are neither parsed nor written again.
+
+As the `@import`ed stylesheets are written to their own files, the imports
+are rewritten to their hashed names, which means that the imported files
+are compiled first and that a change in an imported file changes the hash
+of the files that import it.
+"""
+
+# The number of hexadecimal digits of the digest used in the file names
+HASH_LENGTH = 8
+
+# The name of the manifest in the output directory
+MANIFEST = BUILD_MANIFEST
+
+# -----------------------------------------------------------------------------
+#
+# BUILD
+#
+# -----------------------------------------------------------------------------
+
+class Build:
+	"""Compiles PCSS files to the `output` directory, preserving their paths
+	relative to the `base` directory (by default the common directory of the
+	compiled files)."""
+
+	def __init__( self, output:str, graph:Optional[Graph]=None, base:Optional[str]=None, hashed:bool=True, minify:bool=False, prefixes=None, gzip:Optional[int]=None, options:Optional[List]=None ):
+		self.output   = output
+		self.graph    = graph or Graph()
+		self.base     = base
+		self.hashed   = hashed
+		self.minify   = minify
+		self.prefixes = prefixes
+		# The compression level of the `.css.gz` files, if any
+		self.gzip     = gzip
+		# The options the outputs depend on, which are compared with the
+		# ones of the previous manifest to reuse its outputs.
+		self.options  = options
+		# Maps the normalized source paths to the path of their output,
+		# relative to the output directory.
+		self.outputs:Dict[str,str] = {}
+		# The `(source, output, size, compressed size, written)` of each
+		# output of the last compilation.
+		self.stats:List[tuple] = []
+		# The entries of the previous manifest that are up to date
+		self.fresh:Dict[str,Dict] = {}
+
+	def compile( self, paths:List[str] ) -> Dict:
+		"""Compiles the given files and the stylesheets they import, writes
+		the manifest and returns it."""
+		nodes = [self.graph.get(_) for _ in paths]
+		if self.base is None:
+			self.base = os.path.commonpath([os.path.dirname(_.path) for _ in nodes]) if nodes else "."
+		manifest   = dict(version=1, files={})
+		if self.options is not None:
+			manifest["options"] = self.options
+		self.stats = []
+		self.fresh = self.getFreshEntries()
+		for node in self.sort(nodes):
+			entry = self.getFreshEntry(node.path)
+			if entry:
+				# NOTE: The entry is up to date, so is its output.
+				output = entry["output"]
+				path   = os.path.join(self.output, output)
+				self.stats.append((self.relative(node.path), output, os.path.getsize(path), os.path.getsize(path + ".gz") if self.gzip else None, False))
+			else:
+				artifact = self.write(node)
+				output   = self.getOutput(node.path, artifact.digest)
+				written  = artifact.commit(os.path.join(self.output, output))
+				self.stats.append((self.relative(node.path), output, artifact.size, artifact.compressed if self.gzip else None, written))
+				entry = dict(
+					output       = output,
+					digest       = artifact.digest,
+					dependencies = [self.relative(_.path) for _ in node.dependencies],
+					imports      = [self.relative(_.path) for _ in self.getImports(node)],
+					inputs       = getInputs([node.path] + [_.path for _ in node.dependencies]),
+				)
+				if self.gzip:
+					entry["gzip"] = output + ".gz"
+			self.outputs[node.path] = output
+			manifest["files"][self.relative(node.path)] = entry
+		self.save(MANIFEST, (json.dumps(manifest, indent=1, sort_keys=True) + "\n").encode("utf8"))
+		return manifest
+
+	def sort( self, nodes:List ) -> List:
+		"""Returns the given nodes and the nodes of the stylesheets they
+		import, with the imported nodes before the nodes importing them."""
+		res     = []
+		done    = set()
+		active  = set()
+		stack   = [(_, None) for _ in reversed(nodes)]
+		while stack:
+			node, imports = stack.pop()
+			if imports is None:
+				if node.path in done:
+					continue
+				if node.path in active:
+					raise SemanticError("Circular import of stylesheet: {0}".format(node.path))
+				active.add(node.path)
+				stack.append((node, True))
+				stack.extend((_, None) for _ in reversed(self.getImports(node)))
+			else:
+				active.discard(node.path)
+				if node.path not in done:
+					done.add(node.path)
+					res.append(node)
+		return res
+
+	def getFreshEntries( self ) -> Dict[str,Dict]:
+		"""Returns the entries of the previous manifest whose output is up
+		to date, which requires the same options."""
+		manifest = load(os.path.join(self.output, MANIFEST))
+		if self.options is None or manifest.get("options") != self.options:
+			return {}
+		return dict((k, v) for k, v in (manifest.get("files") or {}).items() if isFreshEntry(v, self.output, bool(self.gzip)))
+
+	def getFreshEntry( self, path:str ) -> Optional[Dict]:
+		"""Returns the up to date entry of the previous manifest for the
+		given source, provided that it was compiled from that source."""
+		entry = self.fresh.get(self.relative(path))
+		return entry if entry and isEntryFor(entry, path) else None
+
+	def getImports( self, node ) -> List:
+		"""Returns the nodes of the stylesheets `@import`ed by the given
+		node (as opposed to `@use`d, which are not written). The imports
+		of the up to date nodes come from the manifest, so that they are
+		not parsed."""
+		entry = self.getFreshEntry(node.path)
+		if entry is not None:
+			return [self.graph.get(os.path.join(self.base, _)) for _ in entry.get("imports", ())]
+		model = node.model
+		if not model:
+			return []
+		return [self.graph.get(_.stylesheet.path) for _ in model.content if isinstance(_, ImportDirective) and not isinstance(_, UseDirective) and _.stylesheet is not None]
+
+	def write( self, node ) -> Artifact:
+		"""Writes the CSS for the given node to an artifact, with the imports
+		rewritten to the outputs of the imported stylesheets."""
+		model = node.model
+		if not model:
+			raise SemanticError("Could not parse: {0}".format(node.path))
+		directory = os.path.dirname(self.getOutput(node.path))
+		imports   = dict((path, os.path.relpath(output, directory or ".").replace(os.sep, "/")) for path, output in self.outputs.items())
+		artifact  = Artifact(os.path.join(self.output, directory), self.gzip)
+		try:
+			CSSWriter(output=artifact, minify=self.minify, prefixes=self.prefixes, imports=imports).write(model)
+		except:
+			artifact.discard()
+			raise
+		return artifact
+
+	# =========================================================================
+	# OUTPUT
+	# =========================================================================
+
+	def relative( self, path:str ) -> str:
+		return os.path.relpath(path, self.base).replace(os.sep, "/")
+
+	def getOutput( self, path:str, digest:Optional[str]=None ) -> str:
+		"""Returns the output path for the given source, relative to the
+		output directory, which only depends on the source path when
+		there is no digest."""
+		name = os.path.splitext(self.relative(path))[0]
+		if self.hashed and digest:
+			return "{0}.{1}.css".format(name, digest[:HASH_LENGTH])
+		else:
+			return name + ".css"
+
+	def save( self, output:str, data:bytes ) -> bool:
+		"""Writes the data to the given output path. The file is written to
+		a temporary file that is then renamed, so that it is never partially
+		written."""
+		path = os.path.join(self.output, output)
+		directory = os.path.dirname(path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		temp = path + ".tmp"
+		with open(temp, "wb") as f:
+			f.write(data)
+		os.replace(temp, path)
+		return True
+
+# EOF - vim: ts=4 sw=4 noet
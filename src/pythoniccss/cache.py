@@ -1,8 +1,12 @@
-import re, os, time, stat, io
-from typing      import List,Optional,Dict,TypeVar,Generic,Callable
-from .grammar    import getGrammar as getPCSSGrammar
+import re, os, time, stat
+from typing      import List,Set,Optional,Dict,TypeVar,Generic,Callable
+from .grammar    import getGrammar as getPCSSGrammar, parsePath as parsePCSSPath
 from .processor  import PCSSProcessor
 from  .writer    import CSSWriter
+from  .model     import ExpansionBudget
+from  .css       import parseCSS
+from  .resolver  import Resolver, getResolver
+from  .source    import Source, getSource
 
 __doc__ = """
 Implements a minimal cache system with dynamic dependencies, used to speed
@@ -21,15 +25,18 @@ def now( at:Optional[float] ) -> float:
 # -----------------------------------------------------------------------------
 
 class Dependencies:
+	"""Extracts the dependencies of a PCSS file by scanning its source with
+	regular expressions. This is only a fast approximation (it also matches
+	text within comments and strings) used for nodes that have not been
+	parsed yet, see `PCSSNode.listDirectDependencies`."""
 
 	RE_INCLUDE = re.compile("@include\s+([^\s]+)")
 	RE_IMPORT  = re.compile("@(import|use)\s+(.+)")
 	RE_URL     = re.compile(".*url\(([^\)]+)\)")
 
 	@classmethod
-	def Parse( cls, path ):
-		with open(path) as f:
-			yield from cls.ParseString(f.read())
+	def Parse( cls, path, source:Optional[Source]=None ):
+		yield from cls.ParseString((source or getSource()).read(path))
 
 	@classmethod
 	def ParseString( cls, text ):
@@ -38,35 +45,6 @@ class Dependencies:
 		for m in cls.RE_IMPORT.finditer(text):
 			yield (m.group(1), m.group(2).strip())
 
-# -----------------------------------------------------------------------------
-#
-# RESOLVER
-#
-# -----------------------------------------------------------------------------
-
-class Resolver:
-
-	PATHS = [
-		"lib/pcss",
-		"lib/css",
-		"src/pcss",
-		"src/css",
-	]
-
-	EXT = [".pcss", ".css"]
-
-	def __init__( self ):
-		self.paths = self.PATHS
-		self.exts  = self.EXT
-
-	def resolve( self, type:str, name:str ) -> Optional[str]:
-		for path in self.paths:
-			for ext in self.exts:
-				p = os.path.join(path, "{0}{1}".format(name, ext))
-				if os.path.exists(p):
-					return p
-		return None
-
 # -----------------------------------------------------------------------------
 #
 # CACHED
@@ -132,6 +110,11 @@ class Memoized(Cached[T]):
 	def value( self, value ):
 		raise Exception("A memoized value cannot have its value set.")
 
+	def invalidate( self ):
+		"""Forces the value to be updated on next access."""
+		self.updated = 0
+		return self
+
 # -----------------------------------------------------------------------------
 #
 # NODE
@@ -144,15 +127,18 @@ class Node:
 
 	def __init__( self, graph:'Graph', path:str ) :
 		self.graph                      = graph
-		self.path                       = os.path.abspath(path)
+		self.path                       = graph.source.normalize(path)
 		self._directDependencies:Memoized[List['Node']] = Memoized(self.listDirectDependencies, lambda:self.modified)
+		self._lastDirectDependencies:Optional[List['Node']] = None
+		# The closure of dependencies is cached along with the graph
+		# revision it was computed at.
+		self._closure:Optional[List['Node']] = None
+		self._closureRevision = -1
 
 	@property
 	def modified( self ) -> float:
 		"""Tells when the node was modified locally"""
-		# OPTIMIZATION. We might want to cache the `stat` and only update
-		# it every 5s or so.
-		return os.stat(self.path)[stat.ST_MTIME]
+		return self.graph.source.modified(self.path)
 
 	@property
 	def changed( self ) -> float:
@@ -160,19 +146,38 @@ class Node:
 		have changed, which is the maximum modified value. """
 		v = self.modified
 		# NOTE: Alternatively, we could do changed on direct dependencies
-		for _ in self.walkDependencies():
+		for _ in self.dependencies:
 			v = max(v,_.modified)
 		return v
 
 	@property
-	def dependencies( self ):
-		"""Returns the cached list of DIRECT and INDIRECT dependencies for the node."""
-		return list(_ for _ in self.walkDependencies())
+	def dependencies( self ) -> List['Node']:
+		"""Returns the cached list of DIRECT and INDIRECT dependencies for the node.
+		The list is shared, and must not be modified."""
+		closure = self._closure
+		if closure is not None and self._closureRevision == self.graph.revision:
+			# We refresh the direct dependencies of every node in the
+			# closure, which bumps the graph revision if any has changed.
+			self.directDependencies
+			for _ in closure:
+				_.directDependencies
+		if closure is None or self._closureRevision != self.graph.revision:
+			closure               = list(self.walkDependencies())
+			self._closure         = closure
+			self._closureRevision = self.graph.revision
+		return closure
 
 	@property
 	def directDependencies( self ):
 		"""Returns the cached list of DIRECT dependencies for the node."""
-		return self._directDependencies.value
+		deps = self._directDependencies.value
+		if deps is not self._lastDirectDependencies:
+			# The memoized value has been updated, we invalidate the
+			# cached closures if the dependencies are not the same.
+			if self._lastDirectDependencies is not None and deps != self._lastDirectDependencies:
+				self.graph.revision += 1
+			self._lastDirectDependencies = deps
+		return deps
 
 	def hasChanged( self, since:float ) -> bool:
 		"""A  node has changed when its `changed` attribute is greated than
@@ -181,19 +186,23 @@ class Node:
 
 	def listDirectDependencies( self ):
 		"""Returns a freshly calculated list of the direct dependencies of this node."""
-		return list(_ for _ in (self.graph.resolve(*_) for _ in Dependencies.Parse(self.path)) if _)
+		base = os.path.dirname(self.path)
+		return list(_ for _ in (self.graph.resolve(t, n, base) for t,n in Dependencies.Parse(self.path, self.graph.source)) if _)
 
-	def walkDependencies( self, visited:Optional[List['Node']]=None ):
+	def walkDependencies( self, visited:Optional[Set['Node']]=None ):
 		"""Walks ALL dependencies (direct and indirect) within that node,
-		making sure not to visit the same node twice."""
-		visited_nodes:List['Node'] = [] if visited is None else visited
-		deps    = [] + self.directDependencies
-		while deps:
-			node = deps.pop(0)
-			if node not in visited_nodes:
+		depth-first and making sure not to visit the same node twice. This
+		does not recurse, so that deep graphs don't hit the recursion limit."""
+		visited_nodes:Set['Node'] = set() if visited is None else visited
+		stack = [iter(self.directDependencies)]
+		while stack:
+			node = next(stack[-1], None)
+			if node is None:
+				stack.pop()
+			elif node not in visited_nodes:
+				visited_nodes.add(node)
 				yield node
-				visited_nodes.append(node)
-				yield from node.walkDependencies(visited_nodes)
+				stack.append(iter(node.directDependencies))
 
 	def __repr__( self ):
 		return "<Node:{0}>".format(self.path)
@@ -213,6 +222,9 @@ class PCSSNode( Node ):
 		self._ast   = Memoized(lambda:self.getAST(),   lambda:self.modified)
 		self._model = Memoized(lambda:self.getModel(), lambda:self.changed)
 		self._css   = Memoized(lambda:self.getCSS(),   lambda:self.changed)
+		# The `(type, path)` dependencies found by the processor when the
+		# model was last created.
+		self._parsedDependencies:Cached[List[tuple]] = Cached()
 
 	@property
 	def ast( self ):
@@ -228,24 +240,69 @@ class PCSSNode( Node ):
 
 	def getAST( self ):
 		# NOTE: We need to return the match, otherwise it won't work
-		return getPCSSGrammar().parsePath(self.path)
+		return parsePCSSPath(self.path, self.graph.source)
+
+	def listDirectDependencies( self ):
+		"""Returns the direct dependencies as resolved by the processor when
+		the model was last created, or falls back to scanning the source
+		when the node has not been processed since it was modified."""
+		parsed = self._parsedDependencies
+		if parsed.value is None or parsed.updated < self.modified:
+			return super().listDirectDependencies()
+		res = []
+		for _, path in parsed.value:
+			node = self.graph.get(path)
+			if node not in res:
+				res.append(node)
+		return res
 
 	def getModel( self ):
-		return PCSSProcessor(path=self.path,graph=self.graph).process(self.ast.match) if self.ast.isSuccess else None
+		if not self.ast.isSuccess:
+			return None
+		processor = PCSSProcessor(path=self.path,graph=self.graph,budget=self.graph.budget)
+		model     = processor.process(self.ast.match)
+		# The dependencies extracted from the parse replace the ones
+		# that were scanned from the source.
+		self._parsedDependencies.value = processor.dependencies
+		self._directDependencies.invalidate()
+		return model
 
 	def getCSS( self ):
 		path = self.path
 		model = self.model
 		if model:
-			s = io.BytesIO()
-			writer = CSSWriter(output=s).write(model)
-			s.seek(0)
-			v = s.getvalue()
-			s.close()
-			return v
+			return b"".join(CSSWriter().chunks(model))
 		else:
 			None
 
+# -----------------------------------------------------------------------------
+#
+# CSS NODE
+#
+# -----------------------------------------------------------------------------
+
+class CSSNode( Node ):
+	"""A node for a plain CSS file, which is not parsed: its model has the
+	text of the file as-is (see `css.parseCSS`), and its CSS is the text.
+	The `@import`s of a CSS file are left to the browser, so it has no
+	dependencies."""
+
+	def __init__( self, graph:'Graph', path:str ):
+		super().__init__(graph, path)
+		self._model = Memoized(lambda:parseCSS(self.path, self.graph.source), lambda:self.modified)
+		self._css   = Memoized(lambda:self.graph.source.read(self.path).encode("utf8"), lambda:self.modified)
+
+	@property
+	def model( self ):
+		return self._model.value
+
+	@property
+	def css( self ):
+		return self._css.value
+
+	def listDirectDependencies( self ):
+		return []
+
 # -----------------------------------------------------------------------------
 #
 # GRAPH
@@ -258,21 +315,28 @@ class PCSSNode( Node ):
 
 class Graph:
 
-	def __init__( self ):
+	def __init__( self, resolver:Optional[Resolver]=None, source:Optional[Source]=None, budget:Optional[ExpansionBudget]=None ):
 		self.nodes = {}
-		self._resolver = Resolver()
+		self.source    = source or (resolver.source if resolver else getSource())
+		# The revision is incremented each time the direct dependencies
+		# of a node change, invalidating the cached closures.
+		self.revision  = 0
+		self.resolver  = resolver or getResolver(self.source)
+		# The limits of the expansion budget used to process the nodes
+		self.budget    = budget
 		self._types = {
-			".pcss": PCSSNode
+			".pcss": PCSSNode,
+			".css" : CSSNode,
 		}
 
 	def synthesizePCSS( self, node ):
-		res = getPCSSGrammar().parsePath(node.path)
-		p   = PCSSProcessor(path=node.path)
+		res = parsePCSSPath(node.path, self.source)
+		p   = PCSSProcessor(path=node.path, source=self.source, resolver=self.resolver, budget=self.budget)
 		m   = p.process(res.match)
 		return m
 
 	def get(self, path:str) -> Optional[Node]:
-		path = os.path.abspath(path)
+		path = self.source.normalize(path)
 		if path not in self.nodes:
 			name,ext = os.path.splitext(path)
 			node_type = self._types.get(ext, Node)
@@ -280,8 +344,14 @@ class Graph:
 			self.nodes[path] = node
 		return self.nodes[path]
 
-	def resolve(self, type:str, name:str) -> Optional[Node]:
-		res =  self._resolver.resolve(type, name)
+	def parse( self, path:str ):
+		"""Returns the parsing result for the PCSS file at the given path,
+		which is cached by the corresponding node."""
+		node = self.get(path)
+		return node.ast if isinstance(node, PCSSNode) else parsePCSSPath(node.path, self.source)
+
+	def resolve(self, type:str, name:str, base:Optional[str]=None) -> Optional[Node]:
+		res =  self.resolver.resolve(name, base)
 		return self.get(res) if res else None
 
 # EOF - vim: ts=4 sw=4 noet
@@ -0,0 +1,148 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+"""
+Pure color operations on `(r, g, b)` and `(r, g, b, a)` tuples, used by the
+`Color` model elements. The operations are memoized, as themes apply the
+same operations to the same colors many times. The `palette` function
+computes the variants of a list of colors in a single pass, using NumPy
+when it is available.
+"""
+
+import colorsys
+from functools import lru_cache
+from typing    import List,Tuple,Iterable
+
+# NumPy is imported on first use by `getNumpy`, as importing it takes
+# longer than compiling a small stylesheet.
+numpy = None
+NUMPY_LOADED = False
+
+def getNumpy():
+	"""Returns the `numpy` module, or `None` when it is not available."""
+	global numpy, NUMPY_LOADED
+	if not NUMPY_LOADED:
+		NUMPY_LOADED = True
+		try:
+			import numpy
+		except ImportError:
+			numpy = None
+	return numpy
+
+# The maximum number of memoized results per operation
+CACHE_SIZE = 4096
+
+# The operations supported by `palette`
+PALETTE_OPERATIONS = ("brighten", "darken", "fade")
+
+# -----------------------------------------------------------------------------
+#
+# OPERATIONS
+#
+# -----------------------------------------------------------------------------
+
+@lru_cache(maxsize=CACHE_SIZE)
+def brighten( value:Tuple, k:float=0.1 ) -> Tuple:
+	"""Adds `k` to the lightness of the given color, preserving its alpha."""
+	h,l,s = colorsys.rgb_to_hls(value[0], value[1], value[2])
+	r,g,b = colorsys.hls_to_rgb(h, l + k, s)
+	return (r,g,b) if len(value) == 3 else (r,g,b,value[3])
+
+def darken( value:Tuple, k:float=0.1 ) -> Tuple:
+	return brighten(value, 0 - k)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def fade( rgba:Tuple, k:float=0.1 ) -> Tuple:
+	"""Fades the color by multiplying `A` by `1-k`."""
+	r,g,b,a = rgba
+	return (r,g,b,min(1.0,max(0,a - a*k)))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def blend( ca:Tuple, cb:Tuple, k:float ) -> Tuple:
+	"""Blends the `ca` and `cb` RGBA colors by `k`, returning an RGBA tuple."""
+	return (
+		ca[0] + (cb[0] - ca[0]) * k,
+		ca[1] + (cb[1] - ca[1]) * k,
+		ca[2] + (cb[2] - ca[2]) * k,
+		ca[3] + (cb[3] - ca[3]) * k,
+	)
+
+# -----------------------------------------------------------------------------
+#
+# PALETTE
+#
+# -----------------------------------------------------------------------------
+
+def palette( values:Iterable[Tuple], operation:str, amounts:Iterable[float], vectorized=None ) -> List[List[Tuple]]:
+	"""Returns, for each of the given color values, the list of the results
+	of the given operation (`brighten`, `darken` or `fade`) applied with each
+	of the amounts. The results are the same as the ones of the individual
+	operations. Lightness operations are vectorized with NumPy if it is
+	available, unless `vectorized` is `False`."""
+	if operation not in PALETTE_OPERATIONS:
+		raise ValueError("Unsupported palette operation: {0}".format(operation))
+	values  = [tuple(_) for _ in values]
+	amounts = list(amounts)
+	if operation == "fade":
+		return [[fade(_ if len(_) > 3 else _ + (1.0,), k) for k in amounts] for _ in values]
+	if operation == "darken":
+		amounts = [0 - _ for _ in amounts]
+	if (vectorized is None and values and amounts and getNumpy() is not None) or vectorized:
+		return _brightenArrays(values, amounts)
+	else:
+		return [[brighten(_, k) for k in amounts] for _ in values]
+
+def _brightenArrays( values:List[Tuple], amounts:List[float] ) -> List[List[Tuple]]:
+	"""Vectorized version of `brighten` over all the values and amounts,
+	mirroring the formulas of `colorsys` so that the results are identical."""
+	getNumpy()
+	rgb   = numpy.array([_[0:3] for _ in values], dtype=numpy.float64)
+	h,l,s = _rgbToHLS(rgb[:,0], rgb[:,1], rgb[:,2])
+	k     = numpy.array(amounts, dtype=numpy.float64)
+	r,g,b = _hlsToRGB(h[:,None], l[:,None] + k[None,:], s[:,None])
+	res   = []
+	for i, value in enumerate(values):
+		row = []
+		for j in range(len(amounts)):
+			c = (float(r[i,j]), float(g[i,j]), float(b[i,j]))
+			row.append(c if len(value) == 3 else c + (value[3],))
+		res.append(row)
+	return res
+
+def _rgbToHLS( r, g, b ):
+	"""Vectorized `colorsys.rgb_to_hls`."""
+	maxc   = numpy.maximum(numpy.maximum(r, g), b)
+	minc   = numpy.minimum(numpy.minimum(r, g), b)
+	sumc   = maxc + minc
+	rangec = maxc - minc
+	l      = sumc / 2.0
+	gray   = minc == maxc
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		s  = numpy.where(l <= 0.5, rangec / sumc, rangec / (2.0 - maxc - minc))
+		rc = (maxc - r) / rangec
+		gc = (maxc - g) / rangec
+		bc = (maxc - b) / rangec
+	h = numpy.where(r == maxc, bc - gc, numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+	h = numpy.mod(h / 6.0, 1.0)
+	return numpy.where(gray, 0.0, h), l, numpy.where(gray, 0.0, s)
+
+def _hlsToRGB( h, l, s ):
+	"""Vectorized `colorsys.hls_to_rgb`, where the arrays are broadcast
+	together."""
+	h, l, s = numpy.broadcast_arrays(h, l, s)
+	m2   = numpy.where(l <= 0.5, l * (1.0 + s), l + s - (l * s))
+	m1   = 2.0 * l - m2
+	gray = s == 0.0
+	return tuple(numpy.where(gray, l, _v(m1, m2, _)) for _ in (h + colorsys.ONE_THIRD, h, h - colorsys.ONE_THIRD))
+
+def _v( m1, m2, hue ):
+	hue = numpy.mod(hue, 1.0)
+	return numpy.where(hue < colorsys.ONE_SIXTH, m1 + (m2 - m1) * hue * 6.0,
+		numpy.where(hue < 0.5, m2,
+		numpy.where(hue < colorsys.TWO_THIRD, m1 + (m2 - m1) * (colorsys.TWO_THIRD - hue) * 6.0, m1)))
+
+# EOF - vim: ts=4 sw=4 noet
@@ -10,12 +10,13 @@
 # -----------------------------------------------------------------------------
 
 from __future__ import print_function
-import re, os, sys, argparse, json, copy, io, time
-from   io        import BytesIO
-from  .grammar   import getGrammar
-from  .processor import PCSSProcessor
-from  .writer    import CSSWriter
-from  .cache     import Graph
+import re, os, sys, argparse, json, copy, io, time, atexit
+from  .writer    import CSSWriter, PREFIX_PROFILES, CHUNK_SIZE
+from  .optimizer import CSSOptimizer
+from  .sourcemap import SourceMap
+from  .artifacts import Artifact
+from  .model     import ExpansionBudget, ExpansionError
+from  .manifest  import BuildManifest, isBuildFresh
 
 try:
 	import reporter
@@ -23,33 +24,74 @@ try:
 except ImportError:
 	import logging
 
-GRAPH = Graph()
+# NOTE: The grammar, the processor and the graph are imported on first use,
+# so that the command line can tell that the outputs are up to date without
+# loading the parser.
+GRAPH = None
 
-def parse(path, convert=True):
-	if GRAPH:
-		node = GRAPH.get(path)
-		return node.css if convert else node.ast
+def getGraph():
+	global GRAPH
+	if GRAPH is None:
+		from .cache import Graph
+		GRAPH = Graph()
+		atexit.register(releaseGraph)
+	return GRAPH
+
+def releaseGraph():
+	"""Releases the graph and the parsing results it caches, which must be
+	freed before the grammar they refer to (libparsing crashes otherwise),
+	while the interpreter exits in no particular order."""
+	global GRAPH
+	GRAPH = None
+
+def getGrammar( *args, **kwargs ):
+	from .grammar import getGrammar
+	return getGrammar(*args, **kwargs)
+
+def parse(path, convert=True, graph=None, minify=False):
+	"""Parses the PCSS file at the given path, using the given graph (and its
+	source provider) or the default one. The CSS is minified when `minify`
+	is true."""
+	graph = graph or getGraph()
+	if graph:
+		node = graph.get(path)
+		if not convert:
+			return node.ast
+		# NOTE: The graph caches the regular CSS, the minified one is
+		# written from the cached model.
+		return writeModel(node.model, minify) if minify else node.css
 	else:
 		res = getGrammar().parsePath(path)
-		return processResult(res, path=path) if convert else res
+		return processResult(res, path=path, minify=minify) if convert else res
 
-def parseString(text, path=None, convert=True):
+def parseString(text, path=None, convert=True, graph=None, minify=False):
+	"""Parses the given PCSS text, resolving its dependencies through the
+	given graph (and its source provider) or the default one."""
 	res = getGrammar().parseString(text)
-	return processResult(res, path=path) if convert else res
+	return processResult(res, path=path, graph=graph, minify=minify) if convert else res
 
-def processResult( result, path=None ):
+def processResult( result, path=None, graph=None, minify=False ):
+	from .processor import PCSSProcessor
 	if result.isSuccess:
-		s = BytesIO()
-		p = PCSSProcessor(path=path, graph=GRAPH)
+		p = PCSSProcessor(path=path, graph=graph or getGraph())
 		m = p.process(result.match)
-		writer = CSSWriter(output=s).write(m)
-		s.seek(0)
-		v = s.getvalue()
-		s.close()
-		return v
+		return writeModel(m, minify)
 	else:
 		raise Exception("Parsing of {0} failed at line:{1}\n> {2}".format("string", result.line, result.describe()))
 
+def stream( path, graph=None, minify=False, size=CHUNK_SIZE ):
+	"""Returns an iterator on the CSS for the PCSS file at the given path, in
+	encoded chunks of the given size, which can be returned as the body of
+	a WSGI response."""
+	model = (graph or getGraph()).get(path).model
+	if not model:
+		raise Exception("Parsing of {0} failed".format(path))
+	return CSSWriter(minify=minify).chunks(model, size)
+
+def writeModel( model, minify=False ):
+	"""Returns the CSS for the given model, as bytes."""
+	return b"".join(CSSWriter(minify=minify).chunks(model))
+
 def run(args):
 	"""Processes the command line arguments."""
 	USAGE = "pythoniccss FILE..."
@@ -63,31 +105,102 @@ def run(args):
 	oparser.add_argument("-o", "--output",   type=str,  dest="output", default=None)
 	oparser.add_argument("--profile",  dest="profile", action="store_true", default=False, help="Profiles the parsing/processing time")
 	oparser.add_argument("--json",     dest="json", action="store_true", default=None)
+	oparser.add_argument("-m", "--minify", dest="minify", action="store_true", default=False, help="Writes minified CSS")
+	oparser.add_argument("-O", "--optimize", dest="optimize", action="store_true", default=False, help="Merges the rules with the same selectors or declarations")
+	oparser.add_argument("--source-map", dest="sourceMap", action="store_true", default=False, help="Writes a source map next to the output file")
+	oparser.add_argument("--prefixes",   dest="prefixes",  type=str, default="all", choices=sorted(PREFIX_PROFILES.keys()), help="The profile of the vendor prefixes to write")
+	oparser.add_argument("--hashed",     dest="hashed",    action="store_true", default=False, help="Writes each file as NAME.HASH.css in the output directory, along with a manifest.json")
+	oparser.add_argument("--gzip",       dest="gzip",      type=int, nargs="?", const=9, default=None, choices=range(1, 10), metavar="LEVEL", help="Also writes a .css.gz next to the output, compressed at the given level (9 by default)")
+	oparser.add_argument("--max-depth",     dest="maxDepth",     type=int, default=ExpansionBudget.DEPTH,     help="The maximum expansion depth of macros, merge() and extend(), 0 for no limit")
+	oparser.add_argument("--max-elements",  dest="maxElements",  type=int, default=ExpansionBudget.ELEMENTS,  help="The maximum number of elements generated by expansions, 0 for no limit")
+	oparser.add_argument("--max-selectors", dest="maxSelectors", type=int, default=ExpansionBudget.SELECTORS, help="The maximum number of selectors per block, 0 for no limit")
+	oparser.add_argument("--themes",        dest="themes",       type=str, default=None, help="A JSON file mapping theme names to variable overrides, compiled to NAME.THEME.css in the output directory")
+	oparser.add_argument("--processes",     dest="processes",    type=int, default=1,    help="The number of processes used to compile the themes")
 	# We create the parse and register the options
 	args = oparser.parse_args(args=args)
 	# p = TreeWriter(output=sys.stdout)
 	if not args.files:
 		sys.stderr.write(USAGE + "\n")
+	if args.themes:
+		return runThemes(args)
+	options = getOptions(args)
+	if args.hashed:
+		if isBuildFresh(args.output or ".", args.files, options, bool(args.gzip)):
+			logging.info("{0} is up to date".format(args.output or "."))
+			return None
+		return runBuild(args, options)
+	outputs  = [args.output + _ for _ in ((".map",) if args.sourceMap and not args.optimize else ()) + ((".gz",) if args.gzip else ())] if args.output else []
+	manifest = BuildManifest.ForOutput(args.output) if args.output and not (args.json or args.profile) else None
+	if manifest and manifest.isFresh(args.output, options, outputs):
+		logging.info("{0} is up to date".format(args.output))
+		return None
+	from .processor import PCSSProcessor
+	graph  = getGraph()
 	output = sys.stdout
 	g = getGrammar(isVerbose=args.verbose)
-	if args.output: output = open(args.output, "wb")
+	if args.output:
+		# NOTE: The output is only replaced once it is complete, and not
+		# at all if it has not changed.
+		output = Artifact(os.path.dirname(args.output), args.gzip)
+	elif args.gzip:
+		logging.error("Compressing requires an output file (-o)")
 	g.prepare()
-	p = PCSSProcessor(grammar=g, graph=GRAPH)
+	budget = ExpansionBudget(args.maxDepth or None, args.maxElements or None, args.maxSelectors or None)
+	graph.budget = budget
+	p = PCSSProcessor(grammar=g, graph=graph, budget=budget)
+	source_map = None
+	if args.sourceMap and not args.output:
+		logging.error("A source map requires an output file (-o)")
+	elif args.sourceMap and args.optimize:
+		logging.error("Source maps are not supported with the optimizer (-O)")
+	elif args.sourceMap:
+		source_map = SourceMap(file=os.path.basename(args.output), root=os.path.dirname(os.path.abspath(args.output)), source=graph.source)
+	# NOTE: The writer is shared by all the files, so that the source map
+	# positions are relative to the whole output.
+	writer = CSSWriter(output=output, minify=args.minify, sourceMap=source_map, prefixes=args.prefixes)
+	# The inputs of the output, which are only recorded when all the files
+	# were compiled.
+	inputs = []
 	for path in args.files:
 		start_time = time.time()
 		result = g.parsePath(path)
 		parse_time = time.time()
 		if result is None:
 			logging.error("Could not find path: {0}".format(path))
+			manifest = None
 		elif result.isSuccess():
 			if args.json:
 				result.toJSON()
 			else:
 				# FIXME: Should set path
 				p.path = path
-				result = p.process(result.match)
-				process_time = time.time()
-				writer = CSSWriter(output=output).write(result)
+				p.dependencies = []
+				try:
+					result = p.process(result.match)
+					process_time = time.time()
+					inputs.append(path)
+					for kind, dependency in p.dependencies:
+						inputs.append(dependency)
+						# NOTE: The included files are processed by `p`, so
+						# their dependencies are already listed, while the
+						# imported ones are processed by the graph, which
+						# records the dependencies of their own parse.
+						if kind != "include":
+							inputs.extend(_.path for _ in graph.get(dependency).dependencies)
+					if args.optimize:
+						optimizer = CSSOptimizer(minify=args.minify, prefixes=args.prefixes)
+						optimizer.write(result, output)
+						before, after = optimizer.stats["bytes"]
+						logging.info("Optimized {0}: {1} bytes saved ({2:0.0f}%)".format(path, before - after, 100.0 * (before - after) / (before or 1)))
+					else:
+						writer.write(result)
+				except ExpansionError as e:
+					logging.error(str(e))
+					for name, count in e.report:
+						logging.error("  {0:8d} elements generated by `{1}`".format(count, name))
+					if args.output:
+						output.discard()
+					return None
 				write_time  = time.time()
 				if args.profile:
 					parse_d   = parse_time    - start_time
@@ -99,14 +212,67 @@ def run(args):
 					logging.info("Parsing time    {0:0.4f}s {1:0.0f}%".format(parse_d,   parse_p))
 					logging.info("Processing time {0:0.4f}s {1:0.0f}%".format(process_d, process_p))
 					logging.info("Writing time    {0:0.4f}s {1:0.0f}%".format(write_d,   write_p))
-				return result
 		else:
 			msg = "Parsing of `{0}` failed at line:{1}#{2}".format(path, result.line, result.offset)
 			logging.error(msg)
 			logging.error("{0} lines".format( len(open(path).read()[0:result.offset].split("\n"))))
 			logging.error(result.describe())
+			manifest = None
+	if source_map:
+		output.write("\n/*# sourceMappingURL={0}.map */\n".format(os.path.basename(args.output)).encode("utf8"))
+		with open(args.output + ".map", "w") as f:
+			source_map.write(f)
 	if args.output:
-		output.close()
+		written = output.commit(args.output)
+		logStats(args.output, output.size, output.compressed if args.gzip else None, written)
+	if manifest:
+		manifest.update(args.output, options, inputs).save()
+
+def getOptions( args ):
+	"""Returns the options the outputs depend on, as recorded in the
+	manifests. The files are kept in order, as the output is their
+	concatenation."""
+	from . import VERSION
+	return [VERSION, [os.path.abspath(_) for _ in args.files] if not args.hashed else None, args.minify, args.optimize, args.sourceMap, args.prefixes, args.gzip, args.maxDepth, args.maxElements, args.maxSelectors]
+
+def logStats( path, size, compressed, written ):
+	"""Logs the size and compression ratio of the given output."""
+	message = "{0}: {1} bytes".format(path, size)
+	if compressed is not None:
+		message += ", {0} bytes compressed ({1:0.0f}%)".format(compressed, 100.0 * compressed / (size or 1))
+	logging.info(message + ("" if written else ", unchanged"))
+
+def runBuild( args, options=None ):
+	"""Compiles the files and the stylesheets they import to hashed files in
+	the output directory, see `build.Build`."""
+	from .build import Build, MANIFEST
+	budget = ExpansionBudget(args.maxDepth or None, args.maxElements or None, args.maxSelectors or None)
+	graph  = getGraph()
+	graph.budget = budget
+	build    = Build(args.output or ".", graph=graph, minify=args.minify, prefixes=args.prefixes, gzip=args.gzip, options=options)
+	manifest = build.compile(args.files)
+	for source, output, size, compressed, written in build.stats:
+		logStats("{0} -> {1}".format(source, output), size, compressed, written)
+	logging.info("Wrote {0}".format(os.path.join(build.output, MANIFEST)))
+	return manifest
+
+def runThemes( args ):
+	"""Compiles the themes defined in `args.themes` for each of the files,
+	parsing and processing each file only once."""
+	from .themes import ThemeCompiler
+	with open(args.themes) as f:
+		themes = json.load(f)
+	directory = args.output or "."
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+	for path in args.files:
+		name     = os.path.splitext(os.path.basename(path))[0]
+		compiler = ThemeCompiler(path=path, graph=getGraph(), minify=args.minify, prefixes=args.prefixes)
+		for theme, css in compiler.compileAll(themes, processes=args.processes).items():
+			output = os.path.join(directory, "{0}.{1}.css".format(name, theme))
+			with open(output, "wb") as f:
+				f.write(css)
+			logging.info("Wrote {0}".format(output))
 
 if __name__ == "__main__":
 	import sys
@@ -0,0 +1,177 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import re
+from   typing  import Dict,Iterator,List,Optional,Tuple
+from  .model   import Stylesheet, Block, Property, RawString, Verbatim
+from  .source  import Source, getSource
+
+__doc__ = """
+Plain CSS sources, which are `@include`d, `@import`ed or `@use`d without
+going through the PCSS grammar: their model is a stylesheet with a single
+`Verbatim` element that writes their text as-is. The text is only tokenized
+when a selector is looked up in it (by `merge()` or `extend()`), and only
+the rules of the selectors that are looked up are turned into blocks.
+"""
+
+EXTENSION  = ".css"
+
+# Matches the comments, keeping the strings in the first group
+RE_COMMENT = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|/\*.*?(?:\*/|$)', re.S)
+
+# Matches the strings and the characters that delimit the rules, selectors
+# and declarations.
+RE_TOKEN   = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|[{}()\[\];,]')
+
+def isCSS( path:str ) -> bool:
+	return path.lower().endswith(EXTENSION)
+
+def stripComments( text:str ) -> str:
+	"""Replaces the comments in the given text with spaces, so that the
+	offsets in the text don't change."""
+	return RE_COMMENT.sub(lambda _:_.group(1) or " " * len(_.group()), text)
+
+def normalize( selector:str ) -> str:
+	return " ".join(selector.split())
+
+def split( text:str, separator:str, offset:int=0 ) -> List[Tuple[int,str]]:
+	"""Splits the given text (without comments) on the given separator, when
+	it is not within strings, parens, brackets or braces, and returns the
+	`(offset, text)` of each part."""
+	res   = []
+	start = 0
+	depth = 0
+	for match in RE_TOKEN.finditer(text):
+		token = match.group()
+		if token in ("(", "[", "{"):
+			depth += 1
+		elif token in (")", "]", "}"):
+			depth = max(0, depth - 1)
+		elif token == separator and not depth:
+			res.append((offset + start, text[start:match.start()]))
+			start = match.end()
+	res.append((offset + start, text[start:]))
+	return res
+
+# -----------------------------------------------------------------------------
+#
+# TOKENIZER
+#
+# -----------------------------------------------------------------------------
+
+def getRules( text:str ) -> Iterator[Tuple[List[str],int,str]]:
+	"""Yields the `(selectors, offset, body)` of the top-level style rules of
+	the given CSS text, in order. The rules nested in at-rules like `@media`
+	are skipped, as their declarations only apply conditionally. The
+	selectors are normalized, and the body is the text of the declarations,
+	at the given offset in the text."""
+	text   = stripComments(text)
+	# The `(prelude, offset of the body)` of the enclosing blocks
+	blocks = []
+	start  = 0
+	depth  = 0
+	for match in RE_TOKEN.finditer(text):
+		token = match.group()
+		if token == "(" or token == "[":
+			depth += 1
+		elif token == ")" or token == "]":
+			depth = max(0, depth - 1)
+		elif depth or len(token) > 1 or token == ",":
+			continue
+		elif token == "{":
+			blocks.append((text[start:match.start()].strip(), match.end()))
+			start = match.end()
+		elif token == "}":
+			if blocks:
+				prelude, body = blocks.pop()
+				if prelude and prelude[0] != "@" and not blocks:
+					yield ([normalize(_[1]) for _ in split(prelude, ",")], body, text[body:match.start()])
+			start = match.end()
+		else:
+			start = match.end()
+
+def getDeclarations( text:str, offset:int=0, path:Optional[str]=None ) -> List[Property]:
+	"""Returns the properties declared in the given body of a rule (without
+	comments), at the given (character) offset in the file at the given path.
+	The values are kept as raw strings, and the nested rules are skipped."""
+	res = []
+	for start, declaration in split(text, ";", offset):
+		name, colon, value = declaration.partition(":")
+		name  = name.strip()
+		value = value.strip()
+		if not colon or not name or not value or value.endswith("}"):
+			continue
+		prop = Property(name, RawString(value))
+		prop._offsets[0] = start + len(declaration) - len(declaration.lstrip())
+		prop._offsets[1] = start + len(declaration.rstrip())
+		prop._source     = path
+		res.append(prop)
+	return res
+
+# -----------------------------------------------------------------------------
+#
+# RULES
+#
+# -----------------------------------------------------------------------------
+
+class CSSRules:
+	"""Finds the rules of a CSS text by selector. The text is tokenized on
+	the first lookup, and a block is created for each selector that is
+	looked up, with the declarations of all the rules that have it."""
+
+	def __init__( self, text:str, path:Optional[str]=None ):
+		self.text   = text
+		self.path   = path
+		# Maps the selectors to the `(offset, body)` of their rules
+		self._rules:Optional[Dict[str,List[Tuple[int,str]]]] = None
+		self._blocks:Dict[str,Block] = {}
+		self.isASCII = text.isascii()
+
+	def findSelector( self, selector:str, block=None ) -> Optional[Block]:
+		selector = normalize(selector)
+		res      = self._blocks.get(selector)
+		if res is None:
+			if self._rules is None:
+				self._rules = {}
+				for selectors, offset, body in getRules(self.text):
+					for _ in selectors:
+						self._rules.setdefault(_, []).append((offset, body))
+			bodies = self._rules.get(selector)
+			if not bodies:
+				return None
+			res = self._blocks[selector] = Block(name=selector)
+			for offset, body in bodies:
+				for _ in getDeclarations(body, offset, self.path):
+					if not self.isASCII:
+						# NOTE: The source maps expect byte offsets
+						_._offsets = [len(self.text[:o].encode("utf8")) for o in _._offsets]
+					res.add(_)
+		return res if res is not block else None
+
+# -----------------------------------------------------------------------------
+#
+# MODEL
+#
+# -----------------------------------------------------------------------------
+
+def createStylesheet( text:str, path:Optional[str]=None ) -> Stylesheet:
+	"""Returns the model for the given CSS text, which is written as-is."""
+	verbatim = Verbatim(text, CSSRules(text, path))
+	verbatim._offsets[0] = 0
+	verbatim._offsets[1] = len(text)
+	verbatim._source     = path
+	res = Stylesheet(path)
+	res._source = path
+	res.add(verbatim)
+	return res
+
+def parseCSS( path:str, source:Optional[Source]=None ) -> Stylesheet:
+	"""Returns the model for the CSS file at the given path, reading it from
+	the given source provider (the disk by default)."""
+	return createStylesheet((source or getSource()).read(path), path)
+
+# EOF - vim: ts=4 sw=4 noet
@@ -10,6 +10,7 @@
 
 from __future__ import print_function
 from   libparsing import *
+from   .source    import getSource
 
 G = None
 
@@ -216,4 +217,9 @@ def getGrammar(isVerbose=False):
 	if not G: G = grammar(isVerbose=isVerbose)
 	return G
 
+def parsePath(path, source=None, grammar=None):
+	"""Parses the PCSS file at the given path, reading it from the given
+	source provider (the disk by default)."""
+	return (source or getSource()).parse(grammar or getGrammar(), path)
+
 # EOF - vim: ts=4 sw=4 noet
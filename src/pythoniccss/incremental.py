@@ -0,0 +1,147 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import re
+from typing     import List,Optional,Dict,Tuple
+from .grammar   import getGrammar
+from .processor import PCSSProcessor
+from .model     import Element, Stylesheet
+
+__doc__ = """
+Incremental parsing of stylesheets. The `Source` axiom of the grammar is a
+flat sequence of top-level items that start at column 0, so a stylesheet
+can be split into top-level chunks that are parsed independently, as long
+as each chunk starts with a line that cannot continue the preceding block.
+When the text changes, only the chunks that are new are parsed again.
+"""
+
+# A top-level chunk starts at column 0 with a line that cannot be a statement
+# of the preceding block: a directive, a line that starts like a selector or
+# a block declaration ending with a colon. Comments, assignments, properties
+# and macro invocations at column 0 may belong to the preceding block, and
+# are kept in its chunk.
+RE_TOPLEVEL = re.compile(r"^(?=\S)(?!#\s)(?=[@.#&*\[:>+~]|[^\n]*:[ \t]*$)", re.M)
+
+# The attributes that are not walked when shifting offsets, as they are
+# not owned by the element.
+NOT_OWNED   = ("_parent", "stylesheet")
+
+# -----------------------------------------------------------------------------
+#
+# HELPERS
+#
+# -----------------------------------------------------------------------------
+
+def splitChunks( text:str ) -> List[str]:
+	"""Splits the text into top-level chunks. Each chunk starts with a line
+	at column 0 that matches `RE_TOPLEVEL` and spans the lines that follow
+	it until the next one. The concatenation of the chunks is the original
+	text."""
+	offsets = [_.start() for _ in RE_TOPLEVEL.finditer(text)]
+	if not offsets or offsets[0] != 0:
+		offsets.insert(0, 0)
+	return [text[start:end] for start, end in zip(offsets, offsets[1:] + [len(text)])]
+
+def shiftOffsets( value, delta:int ):
+	"""Shifts the offsets of the given model elements and their descendants
+	by `delta`, so that the offsets of an element parsed within a chunk
+	become relative to the whole text. Stylesheets (ie. included files)
+	are not shifted, as their offsets are relative to their own file."""
+	visited = set()
+	stack   = [value]
+	while stack:
+		value = stack.pop()
+		if isinstance(value, list) or isinstance(value, tuple):
+			stack.extend(value)
+		elif isinstance(value, dict):
+			stack.extend(value.values())
+		elif isinstance(value, Element) and not isinstance(value, Stylesheet) and id(value) not in visited:
+			visited.add(id(value))
+			offsets = value._offsets
+			if offsets[0] is not None:
+				offsets[0] += delta
+				offsets[1] += delta
+			for k, v in value.__dict__.items():
+				if k not in NOT_OWNED:
+					stack.append(v)
+
+# -----------------------------------------------------------------------------
+#
+# INCREMENTAL PARSER
+#
+# -----------------------------------------------------------------------------
+
+class IncrementalParser:
+	"""Parses successive versions of the same stylesheet, only parsing the
+	top-level chunks that were not in the previous version. The model is
+	then created by processing all the chunks in order, as macros, `merge()`
+	and `extend()` depend on the preceding content, so the result is the
+	same as a full parse. If a chunk cannot be parsed on its own, the
+	whole text is parsed instead."""
+
+	def __init__( self, path:Optional[str]=None, grammar=None, graph=None ):
+		self.path       = path
+		self.grammar    = grammar or getGrammar()
+		self.graph      = graph
+		self.text:Optional[str] = None
+		self.stylesheet:Optional[Stylesheet] = None
+		# Maps the text of the chunks to their parsing result
+		self.chunks:Dict[str,object] = {}
+		# The number of chunks that were parsed by the last update
+		self.parsed     = 0
+
+	def parse( self, text:str ) -> Stylesheet:
+		"""Returns the stylesheet for the given version of the text."""
+		if text == self.text and self.stylesheet:
+			return self.stylesheet
+		chunks      = {}
+		items:List[Tuple[int,object]] = []
+		offset      = 0
+		self.parsed = 0
+		for chunk in splitChunks(text):
+			result = self.chunks.get(chunk) or chunks.get(chunk)
+			if result is None:
+				result       = self.grammar.parseString(chunk)
+				self.parsed += 1
+				if not result.isSuccess():
+					return self.parseFull(text)
+			chunks[chunk] = result
+			items.append((offset, result))
+			# NOTE: Match offsets are byte offsets in the UTF-8 text
+			offset += len(chunk.encode("utf8"))
+		processor       = self.createProcessor()
+		stylesheet      = processor.createStylesheet(self._process(processor, items))
+		stylesheet._offsets = [0, offset]
+		self.chunks     = chunks
+		return self._update(text, stylesheet)
+
+	def parseFull( self, text:str ) -> Stylesheet:
+		"""Parses the whole text, clearing the chunks."""
+		result = self.grammar.parseString(text)
+		if not result.isSuccess():
+			raise Exception("Parsing of {0} failed at line:{1}\n> {2}".format(self.path or "string", result.line, result.describe()))
+		self.chunks  = {}
+		self.parsed  = 1
+		return self._update(text, self.createProcessor().process(result))
+
+	def createProcessor( self ):
+		return PCSSProcessor(grammar=self.grammar, path=self.path or ".", graph=self.graph)
+
+	def _process( self, processor, items ):
+		for offset, result in items:
+			for m in result.match or ():
+				elements = processor.process(m)
+				if offset:
+					shiftOffsets(elements, offset)
+				yield elements
+
+	def _update( self, text:str, stylesheet:Stylesheet ) -> Stylesheet:
+		self.text       = text
+		self.stylesheet = stylesheet
+		return stylesheet
+
+# EOF - vim: ts=4 sw=4 noet
@@ -0,0 +1,135 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import os, json
+from   typing import Dict,List,Optional
+
+__doc__ = """
+Records the inputs of the compiled outputs, so that the command line can
+tell that an output is up to date before importing the parser. For each
+output, the manifest records the options it was compiled with and the
+modification time and size of each file of its dependency closure (see
+`cache.Node.dependencies`). This module only depends on the standard
+library, as it is used before anything else is imported.
+"""
+
+# The name of the manifest of the outputs of the regular compilation, which
+# is stored in the directory of the outputs.
+MANIFEST = ".pcss-manifest.json"
+
+# The name of the manifest of the hashed outputs, see `build.Build`
+BUILD_MANIFEST = "manifest.json"
+
+# -----------------------------------------------------------------------------
+#
+# HELPERS
+#
+# -----------------------------------------------------------------------------
+
+def getStat( path:str ) -> Optional[List[int]]:
+	"""Returns the `[mtime, size]` of the file at the given path, or `None`
+	if it does not exist."""
+	try:
+		s = os.stat(path)
+	except OSError:
+		return None
+	return [s.st_mtime_ns, s.st_size]
+
+def getInputs( paths:List[str] ) -> Dict[str,List[int]]:
+	"""Returns the stats of the given paths, by absolute path."""
+	return dict((os.path.abspath(_), getStat(_)) for _ in paths)
+
+def isFresh( inputs:Optional[Dict[str,List[int]]], outputs:List[str]=() ) -> bool:
+	"""Tells if the given outputs exist and the given inputs (as returned
+	by `getInputs`) have not changed."""
+	if not inputs:
+		return False
+	for path in outputs:
+		if not os.path.exists(path):
+			return False
+	for path, stat in inputs.items():
+		if stat is None or getStat(path) != stat:
+			return False
+	return True
+
+def isEntryFor( entry:Dict, source:str ) -> bool:
+	"""Tells if the given entry of a manifest was compiled from the given
+	source, as the entries are keyed by paths that are relative to the
+	common directory of the compiled files."""
+	return os.path.abspath(source) in (entry.get("inputs") or ())
+
+def load( path:str ) -> Dict:
+	"""Returns the JSON data at the given path, or an empty dict if there is
+	none or if it is invalid."""
+	try:
+		with open(path) as f:
+			data = json.load(f)
+		return data if isinstance(data, dict) else {}
+	except (IOError, OSError, ValueError):
+		return {}
+
+# -----------------------------------------------------------------------------
+#
+# BUILD MANIFEST
+#
+# -----------------------------------------------------------------------------
+
+class BuildManifest:
+	"""The manifest of the outputs of the regular compilation, which maps
+	the absolute path of each output to its options and inputs."""
+
+	@classmethod
+	def ForOutput( cls, output:str ) -> 'BuildManifest':
+		return cls(os.path.join(os.path.dirname(os.path.abspath(output)), MANIFEST))
+
+	def __init__( self, path:str ):
+		self.path    = path
+		self.targets = load(path).get("targets") or {}
+
+	def isFresh( self, output:str, options:List, outputs:List[str]=() ) -> bool:
+		"""Tells if the given output was compiled with the same options, and
+		if its inputs have not changed since. The `outputs` are the other
+		files that must exist, like the source map."""
+		entry = self.targets.get(os.path.abspath(output))
+		return bool(entry) and entry.get("options") == options and isFresh(entry.get("inputs"), [output] + list(outputs))
+
+	def update( self, output:str, options:List, inputs:List[str] ) -> 'BuildManifest':
+		self.targets[os.path.abspath(output)] = dict(options=options, inputs=getInputs(inputs))
+		return self
+
+	def save( self ) -> 'BuildManifest':
+		temp = self.path + ".tmp"
+		with open(temp, "w") as f:
+			json.dump(dict(version=1, targets=self.targets), f, indent=1, sort_keys=True)
+		os.replace(temp, self.path)
+		return self
+
+def isBuildFresh( output:str, paths:List[str], options:List, gzip:bool=False ) -> bool:
+	"""Tells if the hashed outputs of the given source paths in the `output`
+	directory are up to date, using the `BUILD_MANIFEST` written by
+	`build.Build` with its default base directory."""
+	manifest = load(os.path.join(output, BUILD_MANIFEST))
+	if not paths or manifest.get("options") != options:
+		return False
+	paths   = [os.path.abspath(_) for _ in paths]
+	base    = os.path.commonpath([os.path.dirname(_) for _ in paths])
+	entries = manifest.get("files") or {}
+	for path in paths:
+		entry = entries.get(os.path.relpath(path, base).replace(os.sep, "/"))
+		if not entry or not isEntryFor(entry, path) or not isFreshEntry(entry, output, gzip):
+			return False
+	return True
+
+def isFreshEntry( entry:Dict, output:str, gzip:bool=False ) -> bool:
+	"""Tells if the given entry of a `BUILD_MANIFEST` in the `output`
+	directory is up to date."""
+	outputs = [os.path.join(output, entry.get("output") or "")]
+	if gzip:
+		outputs.append(outputs[0] + ".gz")
+	return isFresh(entry.get("inputs"), outputs)
+
+# EOF - vim: ts=4 sw=4 noet
@@ -11,7 +11,8 @@
 
 from __future__ import print_function
 from copy import copy
-import sys, colorsys
+import sys, weakref
+from . import colors
 
 __doc__ = """
 Defines an abstract model for CSS stylesheets.
@@ -40,6 +41,17 @@ class SyntaxError(Exception):
 class SemanticError(Exception):
 	pass
 
+class ExpansionError(SemanticError):
+	"""Raised when the expansion of macros, `merge()` and `extend()` goes
+	over the limits of the expansion budget. The `offsets` are the ones of
+	the invocation that triggered the expansion, and the `report` lists the
+	invocations that contributed the most elements."""
+
+	def __init__( self, message, offsets=None, report=None ):
+		SemanticError.__init__(self, message)
+		self.offsets = offsets
+		self.report  = report or []
+
 class ImplementationError(Exception):
 	pass
 
@@ -56,6 +68,74 @@ def copy( element ):
 	else:
 		return element
 
+# -----------------------------------------------------------------------------
+#
+# BUDGET
+#
+# -----------------------------------------------------------------------------
+
+class ExpansionBudget(object):
+	"""Limits the expansion depth, the total number of elements generated
+	by expansions and the number of selectors per block, so that a large
+	`extend()` or mixins calling mixins fail with an `ExpansionError`
+	instead of exhausting the memory. A limit of `None` disables the
+	corresponding check. The budget also counts the elements generated
+	by each macro, so that the biggest contributors can be reported."""
+
+	DEPTH     = 64
+	ELEMENTS  = 1000000
+	SELECTORS = 10000
+
+	def __init__( self, depth=NOTHING, elements=NOTHING, selectors=NOTHING, path=None ):
+		self.depth         = self.DEPTH     if depth     is NOTHING else depth
+		self.elements      = self.ELEMENTS  if elements  is NOTHING else elements
+		self.selectors     = self.SELECTORS if selectors is NOTHING else selectors
+		self.path          = path
+		self.generated     = 0
+		self.contributions = {}
+
+	def copy( self, path=None ):
+		"""Returns a new budget with the same limits."""
+		return self.__class__(self.depth, self.elements, self.selectors, path)
+
+	def expand( self, elements, name, invocation, depth ):
+		"""Wraps the iterator of elements generated by the given invocation,
+		counting the generated elements (and their descendants) against
+		the budget."""
+		if self.depth is not None and depth > self.depth:
+			self.fail("`{0}` exceeds the expansion depth of {1}".format(name, self.depth), invocation)
+		for element in elements:
+			count = 0
+			nodes = [element]
+			while nodes:
+				node   = nodes.pop()
+				count += 1
+				if isinstance(node, Node):
+					nodes.extend(node.content)
+			self.generated += count
+			self.contributions[name] = self.contributions.get(name, 0) + count
+			if self.elements is not None and self.generated > self.elements:
+				self.fail("`{0}` exceeds the budget of {1} generated elements".format(name, self.elements), invocation)
+			yield element
+
+	def checkSelectors( self, block, count ):
+		if self.selectors is not None and count > self.selectors:
+			self.fail("{0} would have {1} selectors, over the limit of {2}".format(block, count, self.selectors), block)
+
+	def report( self, limit=10 ):
+		"""Returns the `(name, count)` couples of the invocations that
+		generated the most elements, in descending order."""
+		return sorted(self.contributions.items(), key=lambda _:(-_[1], _[0]))[:limit]
+
+	def fail( self, message, element ):
+		offsets = element._offsets
+		if offsets[0] is not None:
+			message = "{0} at {1}:{2}-{3}".format(message, self.path or "string", offsets[0], offsets[1])
+		report = self.report()
+		if report:
+			message += ", most elements were generated by: " + ", ".join("`{0}` ({1})".format(*_) for _ in report)
+		raise ExpansionError(message, offsets=[] + offsets, report=report)
+
 # -----------------------------------------------------------------------------
 #
 # FACTORY
@@ -173,12 +253,16 @@ class Element( object ):
 		self._parent  = None
 		self.isNode   = False
 		self._offsets = [None, None]
+		# The path of the source file the offsets refer to, which is
+		# stamped by the processor.
+		self._source  = None
 
 	def copy( self, value=None):
 		res             = value or self.__class__()
 		res._indent     = self._indent
 		res._offsets[0] = self._offsets[0]
 		res._offsets[1] = self._offsets[1]
+		res._source     = self._source
 		res.isNode      = self.isNode
 		return res
 
@@ -202,7 +286,19 @@ class Element( object ):
 		root = self
 		while root._parent:
 			root =  root._parent
-		return root.resolve(name)
+		return root.getUnit(name) if isinstance(root, Stylesheet) else root.resolve(name)
+
+	def resolveUnitFactor( self, name ):
+		"""Returns the evaluated value of the custom unit with the given name,
+		which is the conversion factor to its base unit, or `None`."""
+		if not name: return None
+		root = self
+		while root._parent:
+			root =  root._parent
+		if isinstance(root, Stylesheet):
+			return root.getUnitFactor(name)
+		custom = root.resolve(name)
+		return custom.value.eval() if custom else None
 
 	def findSelector( self, selector, block=None ):
 		"""Returns the first rule that matches the given selector."""
@@ -214,9 +310,8 @@ class Element( object ):
 				if isinstance(_, ImportDirective):
 					imports.append(_)
 				elif isinstance(_, Block) and _ is not block:
-					for s in _.selectors():
-						if s.expr(namespace=False) == selector:
-							return _
+					if selector in _.selectorExpressions(namespace=False):
+						return _
 			for _ in self.content:
 				s = _.findSelector(selector, block)
 				if s and s is not block: return s
@@ -231,10 +326,10 @@ class Element( object ):
 		raise SemanticError("{0} does not respond to method `{1}`".format(self, name))
 
 	def root( self ):
-		if self._parent:
-			return self._parent.root()
-		else:
-			return self
+		root = self
+		while root._parent:
+			root = root._parent
+		return root
 
 	def parent( self, value=NOTHING ):
 		if value is NOTHING:
@@ -247,16 +342,18 @@ class Element( object ):
 		pass
 
 	def ancestors( self ):
-		if self._parent:
-			return [self._parent] + self._parent.ancestors()
-		else:
-			return []
+		res    = []
+		parent = self._parent
+		while parent:
+			res.append(parent)
+			parent = parent._parent
+		return res
 
 	def ancestor( self, like ):
-		if self._parent:
-			return self._parent if isinstance(self._parent, like) else self._parent.ancestor(like)
-		else:
-			return None
+		parent = self._parent
+		while parent and not isinstance(parent, like):
+			parent = parent._parent
+		return parent or None
 
 	def indent( self, value=NOTHING ):
 		if value is NOTHING:
@@ -297,6 +394,9 @@ class Node( Element ):
 
 	@classmethod
 	def CopyContent( cls, src, dst ):
+		dst._offsets[0] = src._offsets[0]
+		dst._offsets[1] = src._offsets[1]
+		dst._source     = src._source
 		for _ in src.content:
 			dst.add(_.copy())
 		return dst
@@ -306,6 +406,22 @@ class Node( Element ):
 		self.content = []
 		self.isNode  = True
 
+	def parent( self, value=NOTHING ):
+		if value is not NOTHING: self.invalidateSelectors()
+		return Element.parent(self, value)
+
+	def invalidateSelectors( self ):
+		"""Clears the selectors cached by the blocks of this node, including
+		itself, as they depend on their ancestor blocks. This is done when
+		the node is reparented or when the selections of a block change."""
+		nodes = [self]
+		while nodes:
+			node = nodes.pop()
+			if isinstance(node, Block):
+				node._expressions = None
+				node._prefixes    = None
+			nodes.extend(_ for _ in node.content if isinstance(_, Node))
+
 	def indent( self, value=NOTHING ):
 		if value is NOTHING:
 			return self._indent
@@ -347,6 +463,12 @@ class Node( Element ):
 			self._add(value)
 		return self
 
+	def insert( self, index, value ):
+		"""Adds the given value at the given index in the content."""
+		self._add(value)
+		self.content.insert(index, self.content.pop())
+		return self
+
 	def remove( self, value ):
 		if isinstance(value, tuple) or isinstance(value, list):
 			for _ in value:
@@ -356,8 +478,17 @@ class Node( Element ):
 		return self
 
 	def balance( self ):
-		for _ in self.content:
-			_.balance()
+		# NOTE: The tree is walked iteratively so that deeply nested
+		# models (ie. nested macro contexts) don't hit the recursion limit.
+		nodes = [self]
+		while nodes:
+			node = nodes.pop()
+			node._balance()
+			nodes.extend(_ for _ in node.content if isinstance(_, Node))
+
+	def _balance( self ):
+		"""Balances the content of this node only."""
+		pass
 
 	def _add( self, value ):
 		self.content.append(value)
@@ -487,7 +618,9 @@ class Number( Value ):
 	def __init__( self, value, unit=None ):
 		Leaf.__init__(self, value)
 		self.unit  = unit
-		self._isDirty = True
+		# The `(root, units version)` of the stylesheet this number was
+		# evaluated in, see `Stylesheet.updateUnits`.
+		self._version   = None
 		self._evaluated = None
 
 	def copy( self, value=None ):
@@ -498,17 +631,28 @@ class Number( Value ):
 		if self.unit: stream.write(self.unit)
 
 	def eval( self ):
-		if self._isDirty:
-			self._isDirty = False
-			custom = self.resolveUnit(self.unit)
-			if custom:
-				value = custom.value.eval()
-				self._evaluated = Number(
-					value.value * self.value,
-					value.unit
-				)
-			else:
-				self._evaluated = self
+		root = self
+		while root._parent:
+			root = root._parent
+		# NOTE: Outside of a stylesheet, the units can't be versioned, so
+		# the number is evaluated each time.
+		version = (root, root.unitsVersion) if isinstance(root, Stylesheet) else None
+		if version is None or self._version != version:
+			factor = (root.getUnitFactor(self.unit) if version else self.resolveUnitFactor(self.unit)) if self.unit else None
+			self._evaluate(factor, version)
+		return self._evaluated
+
+	def _evaluate( self, factor, version=None ):
+		"""Evaluates this number given the factor of its custom unit, if any,
+		for the given version of the units."""
+		self._version = version
+		if factor:
+			self._evaluated = Number(
+				factor.value * self.value,
+				factor.unit
+			)
+		else:
+			self._evaluated = self
 		return self._evaluated
 
 	def unify( self, value ):
@@ -519,7 +663,7 @@ class Number( Value ):
 		if not a or not b or a == b:
 			return a or b
 		else:
-			raise SemanticError("Cannot unify {0} with {1}".format(self.unit, unit))
+			raise SemanticError("Cannot unify {0} with {1}".format(self.unit, value.unit))
 
 	def convert( self, unit ):
 		custom = self.resolveUnit(unit)
@@ -566,51 +710,46 @@ class Number( Value ):
 		return "<Number {0}{1}>".format(self.value, self.unit or "", id(self))
 
 class Color( Value ):
+	"""Colors are immutable: the color methods return new colors, computed
+	by the memoized operations of the `colors` module."""
+
+	# The methods that can be invoked from PCSS
+	METHODS = ("brighten", "darken", "blend", "fade")
 
 	def invoke( self, name, arguments ):
 		# FIXME: This is a bit of a hack
 		arguments = [_.value if isinstance(_, Number) else _ for _ in arguments or ()]
-		if name == "brighten":
-			return self.brighten(*arguments)
-		elif name == "darken":
-			return self.darken(*arguments)
-		elif name == "blend":
-			return self.blend(*arguments)
-		elif name == "fade":
-			return self.fade(*arguments)
+		if name in self.METHODS:
+			return getattr(self, name)(*arguments)
 		else:
 			return super(Color, self).invoke(name, arguments)
 
 	def brighten( self, k=0.1 ):
-		h,l,s = colorsys.rgb_to_hls(self.value[0], self.value[1], self.value[2])
-		r,g,b = colorsys.hls_to_rgb(h, l + k, s)
-		if len(self.value) == 3:
-			self.value = [r,g,b]
-		else:
-			self.value = [r,g,b, self.value[3]]
-		return self
+		return self.__class__(list(colors.brighten(tuple(self.value), k)))
 
 	def fade( self, k=0.1 ):
 		"""Fades the color by multiplying `A` by `1-k`."""
-		r,g,b,a = self.rgba()
-		return RGBA((r,g,b,min(1.0,max(0,a - a*k))))
+		return RGBA(colors.fade(self.rgba(), k))
 
 	def darken( self, k=0.1 ):
 		return self.brighten(0 - k)
 
 	def blend( self, color, k):
-		k = k.eval().value
-		ca = self.rgba()
-		cb = color.rgba()
-		r = ca[0] + (cb[0] - ca[0]) * k
-		g = ca[1] + (cb[1] - ca[1]) * k
-		b = ca[2] + (cb[2] - ca[2]) * k
-		a = ca[3] + (cb[3] - ca[3]) * k
+		# NOTE: `k` is already a number when the method is invoked from PCSS
+		k = k.eval().value if isinstance(k, Element) else k
+		r,g,b,a = colors.blend(self.rgba(), color.rgba(), k)
 		if a >= 1.0:
 			return RGB((r,g,b)).normalize()
 		else:
 			return RGBA((r,g,b,a)).normalize()
 
+	def palette( self, operation, amounts ):
+		"""Returns the list of the colors resulting from the given operation
+		(`brighten`, `darken` or `fade`) applied with each of the amounts,
+		computed in a single pass."""
+		cls = RGBA if operation == "fade" else self.__class__
+		return [cls(list(_)) for _ in colors.palette([self.value], operation, amounts)[0]]
+
 	def normalize( self ):
 		r = max(0, min(self.value[0], 255))
 		g = max(0, min(self.value[1], 255))
@@ -672,11 +811,16 @@ class Computation( Value ):
 		self.operator = operator
 		self._lvalue  = None
 		self._rvalue  = None
+		# The compiled program is held in a list that is shared with
+		# the copies of this computation.
+		self._program = [None]
 		self.lvalue(lvalue)
 		self.rvalue(rvalue)
 
 	def copy( self ):
-		return self.__class__(self.operator, copy(self._lvalue), copy(self._rvalue))
+		res = self.__class__(self.operator, copy(self._lvalue), copy(self._rvalue))
+		res._program = self._program
+		return res
 
 	def lvalue( self, value=NOTHING ):
 		if value is NOTHING:
@@ -684,7 +828,8 @@ class Computation( Value ):
 		else:
 			if isinstance(value, Element):
 				value.parent(self)
-			self._lvalue = value
+			self._lvalue  = value
+			self._program = [None]
 			return self
 
 	def rvalue( self, value=NOTHING ):
@@ -693,7 +838,8 @@ class Computation( Value ):
 		else:
 			if isinstance(value, Element):
 				value.parent(self)
-			self._rvalue = value
+			self._rvalue  = value
+			self._program = [None]
 			return self
 
 	def add( self, value ):
@@ -709,6 +855,18 @@ class Computation( Value ):
 		return self.eval().sub(value)
 
 	def eval( self, context=None ):
+		program = self._program[0]
+		result  = program.run(self) if program else NOTHING
+		if result is NOTHING:
+			# The computation has not been compiled yet, or its shape
+			# changed since it was compiled.
+			program = self._program[0] = ComputationProgram(self)
+			result  = program.run(self)
+		return result
+
+	def interpret( self ):
+		"""Evaluates the computation by walking the tree, which is what the
+		compiled program does in a single pass."""
 		result = None
 		lvalue = self.lvalue().eval()
 		rvalue = self.rvalue().eval()
@@ -730,6 +888,158 @@ class Computation( Value ):
 	def __repr__( self ):
 		return "<Computation {1} {0} {2} at {3}>".format(self.operator, self.lvalue(), self.rvalue(), id(self))
 
+class ComputationProgram( object ):
+	"""A computation tree compiled into closures. The program is shared by
+	the copies of a computation (ie. the expansions of a macro), so running
+	it only binds the leaves of the given computation: references are
+	resolved once per name, and custom units once per root and name,
+	instead of walking to the root at each operation. The results are the same as with
+	`Computation.interpret`."""
+
+	OPERATORS = {
+		"+" : "add",
+		"-" : "sub",
+		"*" : "mul",
+		"/" : "div",
+	}
+
+	NUMBER    = 0
+	REFERENCE = 1
+	VALUE     = 2
+
+	def __init__( self, computation ):
+		# The kind and the name of each leaf, in the order of `leaves`
+		self.kinds   = []
+		self.names   = []
+		self.program = self._compile(computation)
+
+	def _compile( self, value ):
+		if isinstance(value, Computation):
+			if value.operator not in self.OPERATORS:
+				raise Exception("Unsuported computation operator: {0}".format(value.operator))
+			name   = self.OPERATORS[value.operator]
+			lvalue = self._compile(value._lvalue)
+			rvalue = self._compile(value._rvalue)
+			return lambda values, run: run.apply(name, lvalue(values, run), rvalue(values, run))
+		else:
+			index = len(self.kinds)
+			if value.__class__ is Number:
+				self.kinds.append(self.NUMBER)
+				self.names.append(None)
+			elif isinstance(value, Reference):
+				self.kinds.append(self.REFERENCE)
+				self.names.append(value.value)
+			else:
+				self.kinds.append(self.VALUE)
+				self.names.append(None)
+			return lambda values, run: values[index]
+
+	def leaves( self, computation ):
+		"""Returns the leaves of the given computation, in the order in which
+		they are compiled."""
+		res   = []
+		stack = [computation]
+		while stack:
+			value = stack.pop()
+			if isinstance(value, Computation):
+				stack.append(value._rvalue)
+				stack.append(value._lvalue)
+			else:
+				res.append(value)
+		return res
+
+	def run( self, computation ):
+		"""Runs the program with the leaves of the given computation, returning
+		`NOTHING` if the computation does not have the compiled shape."""
+		leaves     = self.leaves(computation)
+		if len(leaves) != len(self.kinds):
+			return NOTHING
+		run        = ComputationRun(computation)
+		values     = []
+		references = {}
+		for kind, name, leaf in zip(self.kinds, self.names, leaves):
+			if kind == self.NUMBER:
+				if leaf.__class__ is not Number:
+					return NOTHING
+				# NOTE: Leaves are children of the computation, so they
+				# share its root, which we register for the operations.
+				run.roots[id(leaf)] = run.root
+				value = leaf.eval()
+			elif kind == self.REFERENCE:
+				if not isinstance(leaf, Reference) or leaf.value != name:
+					return NOTHING
+				elif name in references:
+					value = references[name]
+				else:
+					# NOTE: Computations are not nodes, so resolving from the
+					# computation is the same as resolving from the leaf.
+					resolved = computation.resolve(name)
+					if resolved is None:
+						raise SemanticError("Variable `{0}` not defined in {1}".format(name, leaf.parent()))
+					value = references[name] = resolved.expand().eval()
+			else:
+				value = leaf.eval()
+			values.append(value)
+		return self.program(values, run)
+
+class ComputationRun( object ):
+	"""The state of a run of a computation program, which caches the
+	resolution of custom units."""
+
+	def __init__( self, computation ):
+		self.root  = computation.root()
+		# Maps the id of the attached values to their root, and the
+		# `(id(root), name)` couples to the resolved unit.
+		self.roots = {}
+		self.units = {}
+
+	def resolveUnit( self, element, name ):
+		"""Returns the same value as `element.resolveUnit(name)`."""
+		if not name:
+			return None
+		if element._parent is None:
+			return element.resolve(name)
+		root = self.roots.get(id(element))
+		if root is None:
+			root = self.roots[id(element)] = element.root()
+		key = (id(root), name)
+		if key not in self.units:
+			self.units[key] = root.getUnit(name) if isinstance(root, Stylesheet) else root.resolve(name)
+		return self.units[key]
+
+	def apply( self, name, lvalue, rvalue ):
+		"""Applies the operation `name` (`add`, `sub`, `mul` or `div`)
+		like the corresponding method of `lvalue`, with the units resolved
+		through this run."""
+		if lvalue.__class__ is not Number or rvalue.__class__ is not Number:
+			return getattr(lvalue, name)(rvalue)
+		rvalue = rvalue.eval()
+		if rvalue.__class__ is not Number:
+			return getattr(lvalue, name)(rvalue)
+		# This is `rvalue.convert(lvalue.unit)`
+		unit = lvalue.unit
+		if self.resolveUnit(rvalue, unit):
+			converted = rvalue.convert(unit)
+		elif not unit or not rvalue.unit or unit == rvalue.unit:
+			converted = rvalue.value
+		else:
+			raise SemanticError("Cannot convert {0} to {1}".format(rvalue, unit))
+		# This is `lvalue.unify(rvalue)`
+		a = self.resolveUnit(lvalue, lvalue.unit) or lvalue.unit
+		b = self.resolveUnit(lvalue, rvalue.unit) or rvalue.unit
+		if not a or not b or a == b:
+			unit = a or b
+		else:
+			raise SemanticError("Cannot unify {0} with {1}".format(lvalue.unit, rvalue.unit))
+		if   name == "add":
+			return Number(lvalue.value + converted, unit)
+		elif name == "sub":
+			return Number(lvalue.value - converted, unit)
+		elif name == "mul":
+			return Number(float(lvalue.value) * converted, unit)
+		else:
+			return Number(float(lvalue.value) / converted, unit)
+
 # -----------------------------------------------------------------------------
 #
 # STATEMENTS
@@ -848,6 +1158,24 @@ class Property( Leaf, Output ):
 	def __repr__( self ):
 		return "<Property {0}={1} at {2}>".format(self.name, self.value, id(self))
 
+class Verbatim( Leaf, Output ):
+	"""CSS text that is written as-is, like the content of a plain `.css`
+	file. The `rules` (see `css.CSSRules`) find the rules of the text by
+	selector, so that `merge()` and `extend()` can reference them without
+	the text being parsed."""
+
+	def __init__( self, value, rules=None ):
+		Leaf.__init__(self, value)
+		Output.__init__(self)
+		self.rules = rules
+
+	def copy( self, value=None ):
+		# NOTE: The rules are shared, so that the text is tokenized once
+		return Element.copy(self, value or self.__class__(self.value, self.rules))
+
+	def findSelector( self, selector, block=None ):
+		return self.rules.findSelector(selector, block) if self.rules else None
+
 # -----------------------------------------------------------------------------
 #
 #  COMPOSITES
@@ -895,10 +1223,14 @@ class Block(Node, TNamed):
 	def __init__( self, selections=None, name=None ):
 		Node.__init__(self)
 		TNamed.__init__(self, name)
-		self.selections = []
-		self._selectors = []
-		self._indent    = 0
-		self._isDirty   = True
+		self.selections   = []
+		# The `(expressions, expressions without namespace)` of the
+		# selectors, computed lazily, see `invalidateSelectors`.
+		self._expressions = None
+		# The `[(expression, selector)]` of the selectors, which are the
+		# prefixes of the child blocks' selectors, see `releasePrefixes`.
+		self._prefixes    = None
+		self._indent      = 0
 		if selections:
 			self.select(selections)
 
@@ -912,49 +1244,89 @@ class Block(Node, TNamed):
 		elif selection:
 			selection.parent(self)
 			self.selections.append(selection)
-			self._isDirty = True
+			self.invalidateSelectors()
 		return self
 
-	def balance( self ):
+	def _balance( self ):
 		blocks     = []
 		non_blocks = []
 		# TODO: There's an opportunity to filter out stuff here
 		for _ in self.content:
-			_.balance()
 			if isinstance(_, Block):
 				blocks.append(_)
 			else:
 				non_blocks.append(_)
 		self.content = non_blocks + blocks
 
-	def parent( self, value=NOTHING ):
-		if value is not NOTHING: self._isDirty = True
-		return super(Node, self).parent(value)
-
 	def selectors( self ):
-		if self._isDirty:
-			r  = []
-			pb = self.ancestor(Block)
-			ps = [_ for _ in pb.selectors()] if pb else []
-			bs = self.selections
-			if ps:
-				if not bs:
-					r += [_.copy() for _ in ps]
-				else:
-					for prefix in ps:
-						for suffix in bs:
-							# NOTE: Narrow already copies
-							rs = prefix.narrow(suffix.copy())
-							r.append(rs)
+		"""Returns the list of selectors for this block, as new selector
+		objects. Use `selectorExpressions` when only the strings are
+		needed, as it does not retain the selectors."""
+		return list(self.iterSelectors())
+
+	def iterSelectors( self ):
+		"""Yields the selectors of this block, which are the product of
+		the parent block's selectors and this block's selections. The
+		selectors are created on demand and not retained, and selectors
+		with the same expression are only yielded once."""
+		for _, selector in self._iterSelectors():
+			yield selector
+
+	def getPrefixes( self ):
+		"""Returns the unique `(expression, selector)` couples of this block,
+		which are the prefixes of its child blocks' selectors. They are
+		cached so that each level of nesting is only expanded once, until
+		`releasePrefixes` is called."""
+		if self._prefixes is None:
+			self._prefixes = list(self._iterSelectors())
+		return self._prefixes
+
+	def releasePrefixes( self ):
+		"""Releases the cached prefixes, which the writer does once the
+		child blocks are written, as only their expressions are kept."""
+		self._prefixes = None
+
+	def _iterSelectors( self ):
+		"""Yields the unique `(expression, selector)` couples."""
+		pb       = self.ancestor(Block)
+		bs       = self.selections
+		module   = self.resolve("__namespace__")
+		prefixes = pb.getPrefixes() if pb else None
+		if prefixes:
+			if bs:
+				budget = getattr(self.root(), "budget", None)
+				if budget: budget.checkSelectors(self, len(prefixes) * len(bs))
+				# NOTE: Narrow already copies
+				product = (prefix.narrow(suffix.copy()) for _, prefix in prefixes for suffix in bs)
 			else:
-				r += bs
-			module = self.resolve("__namespace__")
+				product = (prefix.copy() for _, prefix in prefixes)
+		else:
+			product = bs
+		seen = set()
+		for selector in product:
 			if module:
-				namespace = module.value
-				r = [_.ns(namespace) for _ in r]
-			self._selectors = r
-			self._isDirty   = False
-		return self._selectors
+				selector.ns(module.value)
+			expr = selector.expr()
+			if expr not in seen:
+				seen.add(expr)
+				yield expr, selector
+
+	def selectorExpressions( self, namespace=True ):
+		"""Returns the list of unique expressions of the selectors of this
+		block, with or without the namespace. The expressions are cached
+		until the selectors change, see `invalidateSelectors`."""
+		if self._expressions is None:
+			exprs = []
+			bare  = []
+			seen  = set()
+			for expr, selector in self._iterSelectors():
+				exprs.append(expr)
+				expr = selector.expr(namespace=False)
+				if expr not in seen:
+					seen.add(expr)
+					bare.append(expr)
+			self._expressions = (exprs, bare)
+		return self._expressions[0 if namespace else 1]
 
 	def __repr__( self ):
 		return "<Block `{0}` at {1}>".format(", ".join(_.expr() for _ in self.selections), id(self))
@@ -997,8 +1369,122 @@ class Stylesheet(Node):
 
 	def __init__( self, path=None ):
 		Node.__init__(self)
+		# The registry of the `@unit` directives by name, the imported
+		# stylesheets that are looked up next, and the cache of the
+		# evaluated units as `(version, factors)`.
 		self.units    = {}
+		self.imports  = []
+		self._factors = (None, {})
+		# Incremented each time a unit, an import or a variable (which may
+		# be used in the definition of a unit) is added to or removed from
+		# this stylesheet or from the stylesheets it imports, directly or
+		# not, see `updateUnits`.
+		self.unitsVersion = 0
+		# Maps the stylesheets that import this one to their number of
+		# imports of it. They are weak references, so that the stylesheets
+		# cached by the graph don't keep their importers alive.
+		self._importers = weakref.WeakKeyDictionary()
 		self.path     = path
+		self.budget   = None
+
+	def __getstate__( self ):
+		# NOTE: Weak references can't be pickled, the importers register
+		# again when they are unpickled.
+		state = dict(self.__dict__)
+		del state["_importers"]
+		return state
+
+	def __setstate__( self, state ):
+		importers = self.__dict__.get("_importers")
+		self.__dict__.update(state)
+		self._importers = weakref.WeakKeyDictionary() if importers is None else importers
+		for directive in self.imports:
+			if directive.stylesheet is not None:
+				directive.stylesheet._addImporter(self)
+
+	def _addImporter( self, stylesheet ):
+		# NOTE: When unpickling, this may be called before `__setstate__`
+		importers = self.__dict__.get("_importers")
+		if importers is None:
+			importers = self._importers = weakref.WeakKeyDictionary()
+		importers[stylesheet] = importers.get(stylesheet, 0) + 1
+
+	def _removeImporter( self, stylesheet ):
+		count = self._importers.get(stylesheet, 0) - 1
+		if count > 0:
+			self._importers[stylesheet] = count
+		else:
+			self._importers.pop(stylesheet, None)
+
+	def updateUnits( self ):
+		"""Increments the units version of this stylesheet and of the
+		stylesheets that import it, directly or not, each one once."""
+		visited = set()
+		stack   = [self]
+		while stack:
+			stylesheet = stack.pop()
+			if id(stylesheet) not in visited:
+				visited.add(id(stylesheet))
+				stylesheet.unitsVersion += 1
+				stack.extend(stylesheet._importers.keys())
+		return self
+
+	def _add( self, value ):
+		if isinstance(value, Unit):
+			# Like `resolve`, the first definition wins
+			if value.name not in self.units:
+				self.units[value.name] = value
+				self.updateUnits()
+		elif isinstance(value, ImportDirective):
+			self.imports.append(value)
+			if value.stylesheet is not None:
+				value.stylesheet._addImporter(self)
+			self.updateUnits()
+		elif isinstance(value, Variable):
+			self.updateUnits()
+		return Node._add(self, value)
+
+	def _remove( self, value ):
+		if isinstance(value, Unit) and self.units.get(value.name) is value:
+			del self.units[value.name]
+			for _ in self.content:
+				if _ is not value and isinstance(_, Unit) and _.name == value.name:
+					self.units[value.name] = _
+					break
+			self.updateUnits()
+		elif isinstance(value, ImportDirective) and value in self.imports:
+			self.imports.remove(value)
+			if value.stylesheet is not None:
+				value.stylesheet._removeImporter(self)
+			self.updateUnits()
+		elif isinstance(value, Variable):
+			self.updateUnits()
+		return Node._remove(self, value)
+
+	def getUnit( self, name ):
+		"""Returns the unit with the given name defined in this stylesheet
+		or in the imported stylesheets, like `resolve` does."""
+		unit = self.units.get(name)
+		if unit is None:
+			for directive in reversed(self.imports):
+				if directive.stylesheet:
+					unit = directive.stylesheet.getUnit(name)
+					if unit is not None:
+						return unit
+		return unit
+
+	def getUnitFactor( self, name ):
+		"""Returns the evaluated value of the unit with the given name, which
+		is cached until the units version changes."""
+		version = self.unitsVersion
+		cached, factors = self._factors
+		if cached != version:
+			factors = {}
+			self._factors = (version, factors)
+		if name not in factors:
+			unit = self.getUnit(name)
+			factors[name] = unit.value.eval() if unit else None
+		return factors[name]
 
 	def resolve( self, name ):
 		v = Node.resolve(self, name)
@@ -1179,7 +1665,9 @@ class Selector(Leaf):
 			classes = [self._stripBEM(_) for _ in bem_classes] + classes
 		# And now we output the result
 		suffixes = (" ".join(_ for _ in suffixes if _)) if suffixes else ""
-		classes  = ("." + ".".join(set(classes))) if classes else ""
+		# NOTE: The classes are deduplicated in order, as the iteration
+		# order of a set depends on the hash seed.
+		classes  = ("." + ".".join(dict.fromkeys(classes))) if classes else ""
 		suffix   = "".join(":" + _ for _ in self.suffix)
 		sel      = u"{0}{1}{2}{3}{4}".format(self.node, self.id, classes, self.attributes, suffix)
 		# In the case where we have a module definition an & rule as a direct
@@ -0,0 +1,444 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import io
+from   typing  import Dict,FrozenSet,List,Optional,Tuple
+from  .writer  import CSSWriter
+from  .model   import Output
+
+__doc__ = """
+An optional optimization pass on the CSS generated from a model. The rules
+are collected with their rendered declarations, and then:
+
+- adjacent rules with the same selectors are combined,
+- declarations that are repeated verbatim in a rule are only kept once
+  (the last occurrence is kept, so that the result is the same),
+- rules with identical declarations are merged into the first of them,
+  provided that no rule in between sets a conflicting property.
+
+The text in between the rules (imports, keyframes, verbatim CSS) is kept
+as-is, and as it may contain rules, nothing is combined or merged across it.
+
+Merging moves declarations earlier in the cascade, which is only safe when
+nothing in between could override them. As we can't know which elements
+the selectors match, any rule in between that sets a conflicting property
+prevents the merge. Each property is mapped to the longhands it sets (see
+`SHORTHANDS`), and two properties conflict when they share a longhand:
+`font` conflicts with `line-height`, and `inset` with `top`. The logical
+properties set all the physical properties they may map to, and `all` and
+the properties that are not known conflict with every property. This is
+tracked with a map of the last rule that set each longhand, so that the
+pass is linear in the number of declarations.
+"""
+
+# The sides and corners of the box, used to list the longhands below
+SIDES        = ("top", "right", "bottom", "left")
+CORNERS      = ("top-left", "top-right", "bottom-right", "bottom-left")
+LOGICAL      = ("block-start", "block-end", "inline-start", "inline-end")
+
+# Maps the shorthands to the properties they set, which may be shorthands
+# themselves.
+SHORTHANDS   = {
+	"animation"             : ("animation-name", "animation-duration", "animation-timing-function", "animation-delay", "animation-iteration-count", "animation-direction", "animation-fill-mode", "animation-play-state", "animation-timeline"),
+	"background"            : ("background-color", "background-image", "background-repeat", "background-attachment", "background-position", "background-size", "background-origin", "background-clip"),
+	"background-position"   : ("background-position-x", "background-position-y"),
+	"border"                : ("border-width", "border-style", "border-color", "border-image"),
+	"border-width"          : tuple("border-{0}-width".format(_) for _ in SIDES),
+	"border-style"          : tuple("border-{0}-style".format(_) for _ in SIDES),
+	"border-color"          : tuple("border-{0}-color".format(_) for _ in SIDES),
+	"border-image"          : ("border-image-source", "border-image-slice", "border-image-width", "border-image-outset", "border-image-repeat"),
+	"border-radius"         : tuple("border-{0}-radius".format(_) for _ in CORNERS),
+	"column-rule"           : ("column-rule-width", "column-rule-style", "column-rule-color"),
+	"columns"               : ("column-width", "column-count"),
+	"contain-intrinsic-size": ("contain-intrinsic-width", "contain-intrinsic-height"),
+	"container"             : ("container-name", "container-type"),
+	"flex"                  : ("flex-grow", "flex-shrink", "flex-basis"),
+	"flex-flow"             : ("flex-direction", "flex-wrap"),
+	"font"                  : ("font-style", "font-variant", "font-weight", "font-stretch", "font-size", "line-height", "font-family", "font-size-adjust", "font-kerning", "font-optical-sizing", "font-variation-settings", "font-feature-settings", "font-language-override"),
+	"font-variant"          : ("font-variant-caps", "font-variant-ligatures", "font-variant-numeric", "font-variant-east-asian", "font-variant-alternates", "font-variant-position", "font-variant-emoji"),
+	"gap"                   : ("row-gap", "column-gap"),
+	"grid"                  : ("grid-template", "grid-auto-rows", "grid-auto-columns", "grid-auto-flow"),
+	"grid-template"         : ("grid-template-rows", "grid-template-columns", "grid-template-areas"),
+	"grid-area"             : ("grid-row", "grid-column"),
+	"grid-row"              : ("grid-row-start", "grid-row-end"),
+	"grid-column"           : ("grid-column-start", "grid-column-end"),
+	"inset"                 : SIDES,
+	"list-style"            : ("list-style-type", "list-style-position", "list-style-image"),
+	"mask"                  : ("mask-image", "mask-mode", "mask-repeat", "mask-position", "mask-clip", "mask-origin", "mask-size", "mask-composite"),
+	"offset"                : ("offset-position", "offset-path", "offset-distance", "offset-rotate", "offset-anchor"),
+	"outline"               : ("outline-width", "outline-style", "outline-color"),
+	"overflow"              : ("overflow-x", "overflow-y"),
+	"overscroll-behavior"   : ("overscroll-behavior-x", "overscroll-behavior-y"),
+	"place-content"         : ("align-content", "justify-content"),
+	"place-items"           : ("align-items", "justify-items"),
+	"place-self"            : ("align-self", "justify-self"),
+	"text-decoration"       : ("text-decoration-line", "text-decoration-style", "text-decoration-color", "text-decoration-thickness"),
+	"text-emphasis"         : ("text-emphasis-style", "text-emphasis-color"),
+	"text-wrap"             : ("text-wrap-mode", "text-wrap-style"),
+	"transition"            : ("transition-property", "transition-duration", "transition-timing-function", "transition-delay", "transition-behavior"),
+	"white-space"           : ("white-space-collapse", "text-wrap-mode"),
+}
+for _ in ("margin", "padding", "scroll-margin", "scroll-padding"):
+	SHORTHANDS[_] = tuple("{0}-{1}".format(_, side) for side in SIDES)
+for _ in SIDES:
+	SHORTHANDS["border-" + _] = tuple("border-{0}-{1}".format(_, k) for k in ("width", "style", "color"))
+
+# Maps the logical properties to the physical properties they may set,
+# depending on the writing mode.
+LOGICAL_PROPERTIES = {
+	"block-size"            : ("width", "height"),
+	"inline-size"           : ("width", "height"),
+	"min-block-size"        : ("min-width", "min-height"),
+	"min-inline-size"       : ("min-width", "min-height"),
+	"max-block-size"        : ("max-width", "max-height"),
+	"max-inline-size"       : ("max-width", "max-height"),
+	"overflow-block"        : ("overflow-x", "overflow-y"),
+	"overflow-inline"       : ("overflow-x", "overflow-y"),
+}
+for prefix, physical in (("margin-", "margin"), ("padding-", "padding"), ("scroll-margin-", "scroll-margin"), ("scroll-padding-", "scroll-padding"), ("inset-", "inset"), ("border-", "border"), ("border-", "border-width"), ("border-", "border-style"), ("border-", "border-color")):
+	suffix = physical[len("border"):]
+	for axis in ("block", "inline"):
+		LOGICAL_PROPERTIES[prefix + axis + suffix] = (physical,)
+		for side in ("start", "end"):
+			LOGICAL_PROPERTIES["{0}{1}-{2}{3}".format(prefix, axis, side, suffix)] = (physical,)
+for _ in ("start-start", "start-end", "end-start", "end-end"):
+	LOGICAL_PROPERTIES["border-{0}-radius".format(_)] = ("border-radius",)
+
+# The other properties that are known not to set anything else
+PROPERTIES   = (
+	"accent-color", "align-content", "align-items", "align-self", "appearance", "aspect-ratio",
+	"backdrop-filter", "backface-visibility", "border-collapse", "border-spacing", "bottom", "box-shadow",
+	"box-sizing", "break-after", "break-before", "break-inside", "caption-side", "caret-color", "clear",
+	"clip", "clip-path", "color", "color-scheme", "column-fill", "column-span", "contain", "content",
+	"content-visibility", "counter-increment", "counter-reset", "counter-set", "cursor", "direction",
+	"display", "empty-cells", "fill", "fill-opacity", "filter", "float", "height", "hyphens",
+	"image-rendering", "isolation", "justify-content", "justify-items", "justify-self", "left",
+	"letter-spacing", "max-height", "max-width", "min-height", "min-width", "mix-blend-mode",
+	"object-fit", "object-position", "opacity", "order", "orphans", "outline-offset", "overflow-wrap",
+	"page-break-after", "page-break-before", "page-break-inside", "perspective", "perspective-origin",
+	"pointer-events", "position", "quotes", "resize", "right", "rotate", "scale", "scroll-behavior",
+	"scroll-snap-align", "scroll-snap-stop", "scroll-snap-type", "scrollbar-color", "scrollbar-gutter",
+	"scrollbar-width", "stroke", "stroke-dasharray", "stroke-dashoffset", "stroke-linecap",
+	"stroke-linejoin", "stroke-opacity", "stroke-width", "tab-size", "table-layout", "text-align",
+	"text-align-last", "text-indent", "text-justify", "text-overflow", "text-rendering",
+	"text-shadow", "text-transform", "text-underline-offset", "text-underline-position", "top",
+	"touch-action", "transform", "transform-box", "transform-origin", "transform-style", "translate",
+	"unicode-bidi", "user-select", "vertical-align", "visibility", "widows", "width", "will-change",
+	"word-break", "word-spacing", "writing-mode", "z-index",
+)
+
+# The legacy names of properties
+ALIASES      = {
+	"grid-gap"              : "gap",
+	"grid-row-gap"          : "row-gap",
+	"grid-column-gap"       : "column-gap",
+	"word-wrap"             : "overflow-wrap",
+}
+
+# -----------------------------------------------------------------------------
+#
+# HELPERS
+#
+# -----------------------------------------------------------------------------
+
+def expandLonghands( name:str ) -> FrozenSet[str]:
+	"""Returns the longhands set by the given known property."""
+	res   = set()
+	names = [name]
+	while names:
+		name = names.pop()
+		if name in SHORTHANDS:
+			names.extend(SHORTHANDS[name])
+		elif name in LOGICAL_PROPERTIES:
+			names.extend(LOGICAL_PROPERTIES[name])
+		else:
+			res.add(name)
+	return frozenset(res)
+
+# Maps the known property names to the longhands they set
+LONGHANDS:Dict[str,FrozenSet[str]] = dict((_, expandLonghands(_)) for _ in tuple(SHORTHANDS) + tuple(LOGICAL_PROPERTIES) + PROPERTIES)
+for _ in SHORTHANDS.values():
+	for name in _:
+		if name not in LONGHANDS:
+			LONGHANDS[name] = expandLonghands(name)
+for _, name in ALIASES.items():
+	LONGHANDS[_] = LONGHANDS[name]
+
+def getLonghands( name:str ) -> Optional[FrozenSet[str]]:
+	"""Returns the longhands set by the given property, or `None` when it
+	may set any property, like `all` and the properties that are not
+	known. Vendor prefixed properties set the longhands of the standard
+	property, and custom properties only set themselves."""
+	if name.startswith("--"):
+		return frozenset((name,))
+	if name.startswith("-"):
+		i    = name.find("-", 1)
+		name = name[i+1:] if i > 0 else name
+	return LONGHANDS.get(name)
+
+# -----------------------------------------------------------------------------
+#
+# RULE
+#
+# -----------------------------------------------------------------------------
+
+class Rule:
+	"""A CSS rule, with its selectors and its declarations as
+	`(name, text)` couples."""
+
+	def __init__( self, selectors:List[str] ):
+		self.selectors    = selectors
+		self.declarations = []
+
+	@property
+	def body( self ) -> Tuple[str,...]:
+		return tuple(_[1] for _ in self.declarations)
+
+	def longhands( self ) -> Optional[set]:
+		"""Returns the longhands set by the declarations, or `None` when
+		they may set any property."""
+		res = set()
+		for name, _ in self.declarations:
+			longhands = getLonghands(name)
+			if longhands is None:
+				return None
+			res.update(longhands)
+		return res
+
+	def dedupe( self ):
+		"""Removes the declarations that are repeated verbatim later in
+		the rule."""
+		seen = set()
+		res  = []
+		for _ in reversed(self.declarations):
+			if _[1] not in seen:
+				seen.add(_[1])
+				res.append(_)
+		res.reverse()
+		self.declarations = res
+		return self
+
+# -----------------------------------------------------------------------------
+#
+# RULE COLLECTOR
+#
+# -----------------------------------------------------------------------------
+
+class RuleCollector( CSSWriter ):
+	"""A writer that collects the rules of a model instead of writing them.
+	Anything that is not a rule (imports, keyframes, verbatim CSS) is
+	collected as text, in order."""
+
+	def __init__( self, minify=False, prefixes=None ):
+		CSSWriter.__init__(self, output=None, minify=minify, prefixes=prefixes)
+		self.items = []
+		self._rule = None
+		# The text written since the last collected rule
+		self._text = []
+
+	def collect( self, element ) -> List:
+		self._rule = None
+		self._text = []
+		self.items = []
+		# NOTE: The rules are collected by the handlers as the output is
+		# iterated, so the text in between is added in its place.
+		for _ in self.iterate(element):
+			self._text.append(_)
+		self.flushText()
+		return self.items
+
+	def flushText( self ):
+		"""Adds the text written since the last rule as an item."""
+		text = "".join(self._text)
+		if text:
+			self.items.append(text)
+		self._text = []
+
+	def text( self, value ) -> str:
+		"""Returns the text of the given (nested) generator output."""
+		return "".join(self.flatten(value))
+
+	def onStylesheet( self, element ):
+		for _ in element.content:
+			yield self.on(_)
+
+	def onBlock( self, element ):
+		has_content = next((_ for _ in element.content if isinstance(_, Output)), False)
+		for s in element.selectorExpressions(namespace=False):
+			self._selectors[s] = element
+		if has_content:
+			selectors  = element.selectorExpressions()
+			self._rule = Rule([self.minifySelector(_) for _ in selectors] if self.minify else list(selectors))
+			self.flushText()
+			self.items.append(self._rule)
+		for _ in element.getUniqueContent():
+			yield self.on(_)
+		# The child blocks are written, so their prefixes are not needed
+		element.releasePrefixes()
+
+	def onKeyframes( self, element ):
+		# NOTE: The declarations of the keyframes are written as text, and
+		# not added to the last rule.
+		self._rule = None
+		yield CSSWriter.onKeyframes(self, element)
+
+	def onProperty( self, element ):
+		if self._rule is None:
+			yield CSSWriter.onProperty(self, element)
+			return
+		names = self.prefixes.getNames(element.name)
+		value = self.flatten(self.onValue(element)) if len(names) > 1 else None
+		for name in names:
+			self._rule.declarations.append((name, self.text(self.onDeclaration(element, name, value))))
+
+# -----------------------------------------------------------------------------
+#
+# OPTIMIZER
+#
+# -----------------------------------------------------------------------------
+
+class CSSOptimizer:
+	"""Optimizes the CSS of a model, see the module documentation. The
+	`stats` give the number of rules and bytes before and after the last
+	optimization."""
+
+	def __init__( self, minify=False, prefixes=None ):
+		self.minify   = minify
+		self.prefixes = prefixes
+		self.stats    = {}
+
+	def optimize( self, model ) -> List:
+		"""Returns the optimized list of rules and texts for the given
+		model."""
+		return self.optimizeRules(RuleCollector(self.minify, self.prefixes).collect(model))
+
+	def optimizeRules( self, items:List ) -> List:
+		"""Returns the optimized version of the given list of rules and
+		texts, as collected by a `RuleCollector`."""
+		res = self.mergeBodies(self.combineAdjacent(items))
+		self.stats = dict(
+			rules = (self.countRules(items), self.countRules(res)),
+			bytes = (self.size(items),       self.size(res)),
+		)
+		return res
+
+	def write( self, model, output ):
+		"""Writes the optimized CSS for the given model to the given
+		output."""
+		is_text = isinstance(output, io.TextIOBase)
+		for _ in self.render(self.optimize(model)):
+			output.write(_ if is_text else _.encode("utf8"))
+		output.flush()
+		return output
+
+	def combineAdjacent( self, items:List ) -> List:
+		"""Combines the consecutive rules that have the same selectors, and
+		removes the repeated declarations in each rule. The input rules are
+		left unchanged."""
+		res  = []
+		last = None
+		for item in items:
+			if not isinstance(item, Rule):
+				# NOTE: The text in between rules (imports, keyframes,
+				# verbatim CSS) may contain rules, so it is a barrier.
+				res.append(item)
+				last = None
+			elif last and last.selectors == item.selectors:
+				last.declarations += item.declarations
+			else:
+				last = Rule(list(item.selectors))
+				last.declarations = list(item.declarations)
+				res.append(last)
+		for _ in res:
+			if isinstance(_, Rule):
+				_.dedupe()
+		return res
+
+	def mergeBodies( self, items:List ) -> List:
+		"""Merges the selectors of the rules that have the same declarations
+		into the first of them, when no rule in between sets a conflicting
+		property, and there is no text in between."""
+		res     = []
+		# Maps a body to the index of the last rule in `res` with that body
+		bodies:Dict[tuple,int] = {}
+		# Maps a longhand to the index of the last rule in `res` that sets it
+		touched:Dict[str,int]  = {}
+		# The index of the last rule in `res` that may set any property, and
+		# of the last rule.
+		anything = -1
+		last     = -1
+		# Maps the index of a merge target to its set of selectors
+		selectors:Dict[int,set] = {}
+		for item in items:
+			if not isinstance(item, Rule):
+				res.append(item)
+				bodies  = {}
+				touched = {}
+				continue
+			body      = item.body
+			longhands = item.longhands()
+			i         = bodies.get(body)
+			# NOTE: The target sets the same longhands, so they conflict
+			# when another rule set them since.
+			if i is not None and body and anything <= i and (last == i if longhands is None else all(touched[_] == i for _ in longhands)):
+				target = res[i]
+				known  = selectors.setdefault(i, set(target.selectors))
+				for _ in item.selectors:
+					if _ not in known:
+						known.add(_)
+						target.selectors.append(_)
+			else:
+				i = last = len(res)
+				res.append(item)
+				bodies[body] = i
+				if longhands is None:
+					anything = i
+				else:
+					for _ in longhands:
+						touched[_] = i
+		return res
+
+	# =========================================================================
+	# OUTPUT
+	# =========================================================================
+
+	def render( self, items:List ):
+		"""Yields the text of the given rules and texts, in the same format
+		as the `CSSWriter`."""
+		is_open = False
+		for item in items:
+			if is_open:
+				yield "}" if self.minify else "}\n"
+				is_open = False
+			if not isinstance(item, Rule):
+				yield item
+			elif not item.declarations:
+				continue
+			elif self.minify:
+				yield ",".join(item.selectors)
+				yield "{"
+				yield ";".join(_[1] for _ in item.declarations)
+				is_open = True
+			else:
+				yield "\n"
+				yield ",\n".join(item.selectors)
+				yield " {\n"
+				for _ in item.declarations:
+					yield "  "
+					yield _[1]
+					yield ";\n"
+				is_open = True
+		if is_open:
+			yield "}"
+
+	def size( self, items:List ) -> int:
+		return sum(len(_.encode("utf8")) for _ in self.render(items))
+
+	def countRules( self, items:List ) -> int:
+		return sum(1 for _ in items if isinstance(_, Rule))
+
+# EOF - vim: ts=4 sw=4 noet
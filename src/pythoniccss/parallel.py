@@ -0,0 +1,183 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import os
+from   concurrent.futures import ProcessPoolExecutor
+from   typing       import List,Optional,Tuple
+from  .grammar      import getGrammar
+from  .processor    import PCSSProcessor
+from  .resolver     import Resolver, getResolver
+from  .model        import Element, Stylesheet, ExpansionBudget
+from  .incremental  import splitChunks, shiftOffsets
+
+__doc__ = """
+Parallel parsing of a single stylesheet. The text is cut into batches of
+top-level chunks (see `incremental.splitChunks`), which are parsed and
+processed in a process pool. The processed elements are then dispatched
+in order in the main process, so that macros, `merge()` and `extend()`
+are resolved like in a sequential parse. The files that are included,
+imported or used are resolved by the main process as well, so that they
+are read from the graph's source and parsed only once.
+"""
+
+# The number of batches per process, so that the work is balanced even
+# when the chunks have different parsing costs.
+BATCHES_PER_PROCESS = 4
+
+# -----------------------------------------------------------------------------
+#
+# HELPERS
+#
+# -----------------------------------------------------------------------------
+
+def splitBatches( text:str, count:int ) -> List[Tuple[int,str]]:
+	"""Splits the text into at most `count` batches of consecutive top-level
+	chunks of similar size, returned as `(byte offset, text)` couples."""
+	chunks  = splitChunks(text)
+	size    = max(1, len(text) // max(1, count))
+	batches = []
+	batch   = []
+	length  = 0
+	offset  = 0
+	for chunk in chunks:
+		batch.append(chunk)
+		length += len(chunk)
+		if length >= size:
+			batch_text = "".join(batch)
+			batches.append((offset, batch_text))
+			offset += len(batch_text.encode("utf8"))
+			batch   = []
+			length  = 0
+	if batch:
+		batches.append((offset, "".join(batch)))
+	return batches
+
+def processBatch( path:str, text:str, offset:int ):
+	"""Parses and processes the given batch, returning the list of processed
+	top-level elements (with offsets relative to the whole text), or `None`
+	if the batch could not be parsed. The `@include`, `@import` and `@use`
+	directives are returned as `DeferredDirective`s."""
+	grammar = getGrammar()
+	result  = grammar.parseString(text)
+	if not result.isSuccess():
+		return None
+	processor = BatchProcessor(grammar=grammar, path=path)
+	elements  = []
+	for m in result.match or ():
+		element = processor.process(m)
+		if offset:
+			shiftOffsets(element, offset)
+		elements.append(element)
+	return elements
+
+# -----------------------------------------------------------------------------
+#
+# DEFERRED DIRECTIVES
+#
+# -----------------------------------------------------------------------------
+
+class DeferredDirective( Element ):
+	"""A directive that refers to another file, which is resolved by the
+	main process. The graph of the main process then reads and parses the
+	file once, from its source, instead of once per process."""
+
+	def __init__( self, type:str, value, offset:int, length:int ):
+		Element.__init__(self)
+		self.type    = type
+		self.value   = value
+		self._offsets[0] = offset
+		self._offsets[1] = offset + length
+
+	@property
+	def offset( self ) -> int:
+		return self._offsets[0]
+
+	@property
+	def length( self ) -> int:
+		return self._offsets[1] - self._offsets[0]
+
+	def resolve( self, processor:PCSSProcessor ):
+		"""Returns the result of the directive's handler in the given
+		processor, this directive standing for the match."""
+		return getattr(processor, "on" + self.type)(self, self.value)
+
+def resolveDeferred( processor:PCSSProcessor, value ):
+	"""Returns the given processed value with its deferred directives
+	resolved by the given processor."""
+	if isinstance(value, DeferredDirective):
+		return value.resolve(processor)
+	elif isinstance(value, list) or isinstance(value, tuple):
+		return [resolveDeferred(processor, _) for _ in value]
+	else:
+		return value
+
+class BatchProcessor( PCSSProcessor ):
+	"""Defers the directives that refer to other files."""
+
+	def onInclude( self, match, path ):
+		return DeferredDirective("Include", path, match.offset, match.length)
+
+	def onImport( self, match, source ):
+		return DeferredDirective("Import", source, match.offset, match.length)
+
+	def onUse( self, match, source ):
+		return DeferredDirective("Use", source, match.offset, match.length)
+
+# -----------------------------------------------------------------------------
+#
+# PARALLEL PARSER
+#
+# -----------------------------------------------------------------------------
+
+class ParallelParser:
+	"""Parses a large stylesheet using a pool of processes. The pool is kept
+	until `close` is called, so that each process only builds the grammar
+	once. The expansion budget and the resolver default to the ones of the
+	graph, if any, and are only used by the main process."""
+
+	def __init__( self, path:Optional[str]=None, processes:Optional[int]=None, graph=None, budget:Optional[ExpansionBudget]=None, resolver:Optional[Resolver]=None ):
+		self.path      = path or "."
+		self.processes = processes or os.cpu_count() or 1
+		self.graph     = graph
+		self.budget    = budget   or (graph.budget   if graph else None) or ExpansionBudget()
+		self.resolver  = resolver or (graph.resolver if graph else getResolver())
+		self._pool:Optional[ProcessPoolExecutor] = None
+
+	@property
+	def pool( self ) -> ProcessPoolExecutor:
+		if not self._pool:
+			self._pool = ProcessPoolExecutor(max_workers=self.processes)
+		return self._pool
+
+	def parse( self, text:str ) -> Stylesheet:
+		"""Returns the stylesheet for the given text, falling back to a
+		sequential parse if one of the batches cannot be parsed."""
+		batches   = splitBatches(text, self.processes * BATCHES_PER_PROCESS)
+		futures   = [self.pool.submit(processBatch, self.path, t, o) for o, t in batches]
+		results   = [_.result() for _ in futures]
+		processor = PCSSProcessor(path=self.path, graph=self.graph, resolver=self.resolver, budget=self.budget)
+		if None in results:
+			result = processor.grammar.parseString(text)
+			if not result.isSuccess():
+				raise Exception("Parsing of {0} failed at line:{1}\n> {2}".format(self.path, result.line, result.describe()))
+			return processor.process(result)
+		stylesheet = processor.createStylesheet(resolveDeferred(processor, e) for elements in results for e in elements)
+		stylesheet._offsets = [0, len(text.encode("utf8"))]
+		return stylesheet
+
+	def close( self ):
+		if self._pool:
+			self._pool.shutdown()
+			self._pool = None
+
+	def __enter__( self ):
+		return self
+
+	def __exit__( self, *args ):
+		self.close()
+
+# EOF - vim: ts=4 sw=4 noet
@@ -2,17 +2,15 @@
 # Encoding: utf-8
 
 from __future__ import print_function
-from libparsing import Processor, ensure_str, is_string
-from .grammar import grammar, getGrammar
-from .model   import Factory, Stylesheet, Element, Block, Macro, MacroInvocation, URL, Node, String, SemanticError
-import re, os, sys
+from libparsing import Processor, Match, MatchResult, ensure_str, is_string
+from .grammar import grammar, getGrammar, parsePath
+from .model   import NOTHING, ExpansionBudget, Factory, Stylesheet, Element, Block, Macro, MacroInvocation, URL, Node, String, SemanticError
+from .css     import isCSS, parseCSS
+from .resolver import getResolver
+from .source   import getSource
+import re, os, sys, inspect
 
 BASE  = os.path.dirname(os.path.abspath(__file__))
-PCSS_PATHS = [
-	".",
-	"lib/pcss",
-	"src/pcss"
-]
 
 COLOR_PROPERTIES     = (
 	"background",
@@ -28,6 +26,12 @@ class PCSSProcessor(Processor):
 
 	RGB = None
 
+	# Maps `(class, grammar)` to the symbol tables and to the handler table,
+	# which lists the `(symbol id, method name, slot indexes)` of each
+	# `on<RuleName>` handler. This is computed once instead of for each
+	# processor instance.
+	DISPATCH = {}
+
 	@classmethod
 	def ColorFromName( cls, name ):
 		"""Retrieves the (R,G,B) color triple for the color of the given name."""
@@ -54,33 +58,124 @@ class PCSSProcessor(Processor):
 		else:
 			return cls.RGB[name.lower().strip()]
 
-	def __init__( self, grammar=None, path=".", graph=None):
+	def __init__( self, grammar=None, path=".", graph=None, resolver=None, source=None, budget=None):
 		Processor.__init__(self, grammar or getGrammar())
 		self.F      = Factory()
 		self.path   = path
 		self.graph  = graph
+		# The source and resolver are shared with the graph so that both
+		# resolve modules to the same paths.
+		self.source   = source   or (graph.source   if graph else getSource())
+		self.resolver = resolver or (graph.resolver if graph else getResolver(self.source))
+		# The `(type, path)` couples of the files resolved by `@include`,
+		# `@import` and `@use` while processing.
+		self.dependencies = []
+		# The limits of the expansion budget, which is copied for each
+		# created stylesheet.
+		self.budget       = budget or ExpansionBudget()
 		self._stylesheets = {}
+		# The paths of the files being included, as the offsets of their
+		# elements refer to them and not to `path`.
+		self._includes    = []
+
+	# =========================================================================
+	# DISPATCH
+	# =========================================================================
+
+	def setGrammar( self, grammar ):
+		"""Binds the handlers using the dispatch table of the grammar, which
+		is created on first use. The grammar is kept to parse the included
+		files when there is no graph."""
+		self.grammar = grammar
+		key   = (self.__class__, grammar)
+		table = self.DISPATCH.get(key)
+		if not table:
+			self.symbols      = grammar.list() if grammar else []
+			self.symbolByName = {}
+			self.symbolByID   = {}
+			self._bindSymbols()
+			table = self.DISPATCH[key] = (self.symbols, self.symbolByName, self.symbolByID, self.createDispatchTable())
+		self.symbols, self.symbolByName, self.symbolByID, handlers = table
+		self.handlerByID = dict((i, self._bindPositionalHandler(name, slots)) for i, name, slots in handlers)
+
+	def createDispatchTable( self ):
+		"""Returns the `(symbol id, method name, slot indexes)` for each of the
+		`on<RuleName>` handlers, where the slot indexes correspond to the
+		named arguments of the handler."""
+		table = []
+		for k in dir(self.__class__):
+			if not k.startswith("on") or len(k) == 2: continue
+			name = k[2:]
+			assert not self.isStrict or name in self.symbolByName, "Handler does not match any symbol: {0}".format(k)
+			symbol = self.symbolByName.get(name)
+			if not symbol: continue
+			params  = [_ for _ in inspect.signature(getattr(self.__class__, k)).parameters.values() if _.default is _.empty]
+			slots   = [(_.name, symbol.indexForKey(_.name)) for _ in params[2:]]
+			missing = [_ for _ in slots if _[1] < 0]
+			if missing:
+				raise Exception("Handler {0} for {1} arguments do not match grammar: {2} should be a subset of {3}".format(k, symbol, missing, symbol.slots()))
+			table.append((symbol.id, k, tuple(_[1] for _ in slots)))
+		return table
+
+	def _bindPositionalHandler( self, name, slots ):
+		"""Returns a handler that passes the processed slots as positional
+		arguments, without the reflection of the generic processor."""
+		handler = getattr(self, name)
+		process = self.process
+		if not slots:
+			return handler
+		elif len(slots) == 1:
+			a, = slots
+			return lambda match:handler(match, process(match[a]))
+		elif len(slots) == 2:
+			a, b = slots
+			return lambda match:handler(match, process(match[a]), process(match[b]))
+		elif len(slots) == 3:
+			a, b, c = slots
+			return lambda match:handler(match, process(match[a]), process(match[b]), process(match[c]))
+		else:
+			return lambda match:handler(match, *[process(match[_]) for _ in slots])
+
+	def process( self, match ):
+		"""A direct version of `Processor.process` for the lazy strategy. Only
+		matches with a handler are processed here, the other ones are
+		processed by the generic processor."""
+		if isinstance(match, Match):
+			handler = self.handlerByID.get(match.id)
+			# NOTE: A handler that processes its own match gets the default
+			# processing, as in the generic processor.
+			if handler and handler is not self._handler:
+				previous      = self._handler
+				self._handler = handler
+				result        = handler(match)
+				self._handler = previous
+				return result.value if isinstance(result, MatchResult) else result
+		return Processor.process(self, match)
+
+	# =========================================================================
+	# RESOLUTION
+	# =========================================================================
 
 	def resolvePCSS( self, name ):
 		"""Resolves the PCSS file with the given name, or by URL if
 		name is @model.URL instance."""
 		if isinstance(name, URL):
-			rp = os.path.relpath(name.value, self.path)
+			rp = os.path.relpath(name.value, self.path or ".")
 			ap = os.path.abspath(name.value)
 			dp = os.path.normpath(name.value)
-			if os.path.exists(rp): return rp
-			if os.path.exists(ap): return ap
-			if os.path.exists(dp): return dp
+			if self.source.exists(rp): return rp
+			if self.source.exists(ap): return ap
+			if self.source.exists(dp): return dp
 			return None
 		else:
 			name = name.value if isinstance(name,String) else name
-			current = os.path.dirname(self.path) if os.path.isfile(self.path) else self.path
-			for parent in [current] + PCSS_PATHS:
-				for ext in ("", ".pcss"):
-					path = os.path.join(parent, name + ext)
-					if os.path.exists(path):
-						return path
-			return False
+			# NOTE: Stylesheets parsed from a string may have no path, they
+			# are then resolved from the search paths only.
+			if not self.path:
+				current = None
+			else:
+				current = os.path.dirname(self.path) if self.source.exists(self.path) else self.path
+			return self.resolver.resolve(name, current) or False
 
 	# =========================================================================
 	# HIGH-LEVEL STRUCTURE
@@ -88,24 +183,61 @@ class PCSSProcessor(Processor):
 
 	def onSource( self, match ):
 		"""Regroups the lines of the stylesheet based on their indentation."""
-		def dispatch( element, stack, guard=None, depth=0):
-			"""Processes the given element so that it is added to the matching
-			parent in the stack. If `guard` is given, then the stack is not
-			unwinded past `guard`."""
-			# NOTE: The stack is going to be like that
-			# [
-			#    [ A, B, C, … ]   # Level 0
-			#    [ D, E, … ]      # Level 1
-			#    …
-			# ]
-			#
-			# Where each stack Level contains a list of PCSS model elements.
-			if isinstance(element, Stylesheet):
+		return self.createStylesheet(self.process(m) for m in match).offsets(match)
+
+	def stampSource( self, element, path ):
+		"""Sets the source path of the given element and its descendants
+		that don't have one yet. Elements that come from other files
+		(imported macros, included files) are already stamped, and their
+		copies keep their source."""
+		nodes = [element]
+		while nodes:
+			node = nodes.pop()
+			if node._source is None:
+				node._source = path
+			if isinstance(node, Node):
+				nodes.extend(node.content)
+		return element
+
+	def createStylesheet( self, elements ):
+		"""Creates the stylesheet from the given iterable of processed
+		top-level elements, which are dispatched in order. The elements are
+		stamped with the path of the file being processed, as the incremental
+		and parallel parsers process the top-level elements themselves."""
+		# NOTE: The stack is going to be like that
+		# [
+		#    [ A, B, C, … ]   # Level 0
+		#    [ D, E, … ]      # Level 1
+		#    …
+		# ]
+		#
+		# Where each stack Level contains a list of PCSS model elements.
+		#
+		# The dispatching is iterative so that deeply nested macro
+		# invocations and lists don't hit the recursion limit. Each frame
+		# is `(items, stack, guard, depth)`, where `items` is an iterator
+		# on the elements to dispatch in the given `stack`, which is not
+		# unwinded past `guard`, and `depth` is the expansion depth.
+		# Frames are consumed lazily, so that the copies of expanded
+		# elements are created in the same order as with a recursive
+		# traversal, and are counted against the budget as they are created.
+		s      = self.F.stylesheet(self.path)
+		budget = s.budget = self.budget.copy(self.path)
+		root   = [s]
+		frames = [(iter(elements), root, None, -1)]
+		while frames:
+			items, stack, guard, depth = frames[-1]
+			element = next(items, NOTHING)
+			if element is NOTHING:
+				frames.pop()
+			elif depth < 0:
+				# This is the list of top-level elements
+				frames.append((iter(element), stack, None, 0))
+			elif isinstance(element, Stylesheet):
 				# Stylesheets are added as direct children of the root
 				# (which happens to be a stylesheet)
 				for _ in element.content:
 					stack[0].add(_)
-				return stack
 			elif isinstance(element, MacroInvocation):
 				# When we register a macro invocation we look for defined
 				# blocks and expand them
@@ -123,10 +255,14 @@ class PCSSProcessor(Processor):
 					# It's important to have a copy of the stack here
 					substack  = [] + stack
 					indent    = element._indent or 0
-					for _ in block.content:
-						if recursive or not isinstance(_, Node):
-							# NOTE: We need to correct the indentation
-							substack = dispatch(_.copy().indent(indent + 1), substack, head, depth + 1)
+					# NOTE: We need to correct the indentation
+					frames.append((
+						budget.expand(
+							(_.copy().indent(indent + 1) for _ in block.content if recursive or not isinstance(_, Node)),
+							"{0}({1})".format(element.name, sel_name), element, depth + 1
+						),
+						substack, head, depth + 1
+					))
 				else:
 					# We have a macro invocation which we resolve
 					macro = stack[0].resolve(element.name) or stack[0].findSelector("." + element.name, stack[-1])
@@ -143,12 +279,15 @@ class PCSSProcessor(Processor):
 						# we create a substack that won't alter the current stack
 						substack = stack + [context]
 						indent   = element._indent or 0
-						# We iterate on the macro content
-						for _ in macro.content:
-							# We copy each element and assign the context
-							# as a parent.
-							_ = _.copy().indent(indent + 1).parent(context)
-							substack = dispatch(_, substack, context, depth + 1)
+						# We copy each element of the macro content and
+						# assign the context as a parent.
+						frames.append((
+							budget.expand(
+								(_.copy().indent(indent + 1).parent(context) for _ in macro.content),
+								element.name, element, depth + 1
+							),
+							substack, context, depth + 1
+						))
 					elif macro:
 						raise SemanticError("`{0}` does not resolve `{1}` to macro, got {2}".format(element.name, element.name, macro))
 					else:
@@ -156,35 +295,28 @@ class PCSSProcessor(Processor):
 			elif isinstance(element, Macro):
 				# Macros are toplevel, so we don't need to take indentation into
 				# account.
-				while len(stack) > 1: stack.pop()
+				del stack[1:]
 				stack[0].add(element)
 				stack.append(element)
-				return stack
 			elif isinstance(element, Element):
 				if element._indent is not None:
-					while stack and stack[-1]._indent != None and stack[-1]._indent >= element._indent and stack[-1] != guard:
-						stack.pop()
-					assert stack
+					# We rewind the stack to the parent of the element in
+					# one go.
+					i = len(stack)
+					while i and stack[i - 1]._indent is not None and stack[i - 1]._indent >= element._indent and stack[i - 1] is not guard:
+						i -= 1
+					assert i
+					del stack[i:]
 				stack[-1].add(element)
 				if isinstance(element, Node):
 					stack.append(element)
 			elif isinstance(element, tuple) or isinstance(element, list):
-				for _ in element:
-					stack = dispatch(_, stack, None, depth + 1)
+				frames.append((iter(element), stack, None, depth))
 			else:
 				pass
 				# ERROR: Not expected
-			return stack
-		# === Main loop ===
-		# This takes the stylesheet and dispatches everyhting
-		# We parse the content
-		s     = self.F.stylesheet(self.path)
-		stack = [s]
-		for m in match:
-			for _ in self.process(m):
-				dispatch(_, stack)
 		s.balance()
-		return s.offsets(match)
+		return self.stampSource(s, self._includes[-1] if self._includes else self.path)
 
 	def onBlock( self, match, indent, selections, name, code ):
 		# The ordering of statements is deferred to the `onSource` rule
@@ -199,29 +331,41 @@ class PCSSProcessor(Processor):
 	def onInclude( self, match, path ):
 		rpath = self.resolvePCSS(path)
 		if rpath:
-			result = self.grammar.parsePath(rpath)
-			result = self.process(result)
+			self.dependencies.append(("include", rpath))
+			if isCSS(rpath):
+				# NOTE: Plain CSS is not parsed, the included stylesheet has
+				# a copy of its verbatim text, which shares its rules.
+				return Node.CopyContent(self.parseStylesheet(rpath), Stylesheet(rpath))
+			# NOTE: The graph caches the parsing result, which is shared
+			# by all the stylesheets that include the same file.
+			result = self.graph.parse(rpath) if self.graph else parsePath(rpath, self.source, self.grammar)
+			self._includes.append(rpath)
+			try:
+				result = self.process(result)
+			finally:
+				self._includes.pop()
 			return result
 		else:
 			raise SemanticError("Cannot resolve PCSS file: {0}".format(path))
 
 	def onImport( self, match, source ):
-		return self._onImportOrUse(match, source, self.F._import)
+		return self._onImportOrUse(match, source, self.F._import, "import")
 
 	def onUse( self, match, source ):
-		return self._onImportOrUse(match, source, self.F.use)
+		return self._onImportOrUse(match, source, self.F.use, "use")
 
-	def _onImportOrUse( self, match, source, factoryMethod ):
+	def _onImportOrUse( self, match, source, factoryMethod, type ):
 		source = source[0]
 		source = source.value if isinstance(source,String) else source
 		path   = self.resolvePCSS(source)
 		if path == self.path:
 			raise SemanticError("Stylesheet importing itself: {0} at {1}".format(source, path))
 		elif path:
+			self.dependencies.append((type, path))
 			# NOTE: Using the graph considerably accelerates the processing,
 			# as AST and Model are going to be cached.
 			stylesheet = self.parseStylesheet(path)
-			relpath    = os.path.relpath(path ,os.path.dirname(self.path))
+			relpath    = os.path.relpath(path ,os.path.dirname(self.path)) if self.path else path
 			return factoryMethod(source, stylesheet, relpath).offsets(match)
 		elif isinstance(source, URL):
 			return factoryMethod(source, None).offsets(match)
@@ -234,16 +378,17 @@ class PCSSProcessor(Processor):
 			return node.model
 		elif path in self._stylesheets:
 			return self._stylesheets[path]
+		elif isCSS(path):
+			stylesheet = self._stylesheets[path] = parseCSS(path, self.source)
+			return stylesheet
 		else:
-			result     = self.grammar.parsePath(path)
-			stylesheet = PCSSProcessor(path=path).process(result)
+			result     = parsePath(path, self.source, self.grammar)
+			stylesheet = PCSSProcessor(grammar=self.grammar, path=path, source=self.source, resolver=self.resolver, budget=self.budget).process(result)
 			self._stylesheets[path] = stylesheet
 			return stylesheet
 
-	def onStatement( self, match ):
-		indent  = self.process(match["indent"])
-		op      = self.process(match["op"])[0]
-		return op.indent(indent)
+	def onStatement( self, match, indent, op ):
+		return op[0].indent(indent)
 
 	def onDirective( self, match ):
 		return self.process(match[0])
@@ -279,21 +424,18 @@ class PCSSProcessor(Processor):
 	# STATEMENTS
 	# =========================================================================
 
-	def onCSSProperty( self, match ):
+	def onCSSProperty( self, match, name, values, important ):
 		"""The main CSS declaration."""
-		name      = self.process(match["name"])
-		values    = self.process(match["values"])
 		values    = self.F.list(values).unwrap() if isinstance(values, list) else values
-		important = self.process(match["important"])
 		if name in COLOR_PROPERTIES and values:
 			if isinstance(values, String):
 				rgb = self.ColorFromName(values.value)
 				if rgb: values = self.F.rgb(rgb)
 		return self.F.property(name, values, important).offsets(match)
 
-	def onAssignment( self, match ):
+	def onAssignment( self, match, declaration ):
 		"""The statement of a declaration."""
-		return self.process(match["declaration"])
+		return declaration
 
 	def onVariable( self, match, name, value ):
 		"""The declaration of a variable or special directive
@@ -412,15 +554,11 @@ class PCSSProcessor(Processor):
 	# SELECTIONS
 	# =========================================================================
 
-	def onSelections( self, match ):
-		head = self.process(match["head"])
-		tail = self.process(match["tail"])
+	def onSelections( self, match, head, tail ):
 		head = [head] + ([_[1] for _ in tail or []])
 		return head
 
-	def onSelection( self, match ):
-		head = self.process(match["head"])
-		tail = self.process(match["tail"])
+	def onSelection( self, match, head, tail ):
 		for op, sel in tail:
 			if sel:
 				if not head:
@@ -429,12 +567,7 @@ class PCSSProcessor(Processor):
 				head = head.narrow(sel, op.strip() if op else None)
 		return head
 
-	def onSelector( self, match ):
-		node       =  self.process(match["node"])
-		nid        =  self.process(match["nid"])
-		nclass     =  self.process(match["nclass"])
-		attributes =  self.process(match["attributes"])
-		suffix     =  self.process(match["suffix"])
+	def onSelector( self, match, node, nid, nclass, attributes, suffix ):
 		node       = node[0] if node else ""
 		nid        = nid if nid else ""
 		bang_suffix = []
@@ -457,14 +590,10 @@ class PCSSProcessor(Processor):
 		sel = sel or None
 		return [op, sel] if (op or sel) else None
 
-	def onAttribute( self, match ):
-		name  =  self.process(match["name"])
-		value =  self.process(match["value"])
+	def onAttribute( self, match, name, value ):
 		return "[{0}{1}{2}]".format(name, value[0] if value else "", value[1] if value else "")
 
-	def onAttributes( self, match ):
-		head =  self.process(match["head"])
-		tail =  self.process(match["tail"])
+	def onAttributes( self, match, head, tail ):
 		assert not tail
 		result = "".join([head] + (tail or []))
 		return  result
@@ -473,8 +602,8 @@ class PCSSProcessor(Processor):
 	# INDENTATION
 	# =========================================================================
 
-	def onCheckIndent( self, match ):
-		return len(self.process(match["tabs"]))
+	def onCheckIndent( self, match, tabs ):
+		return len(tabs)
 
 	# =========================================================================
 	# GENERIC GRAMMAR RULES
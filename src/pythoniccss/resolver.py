@@ -0,0 +1,94 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import os
+from typing import List,Optional,Dict,Tuple
+from .source import Source, getSource
+
+__doc__ = """
+Resolves the names used in `@include`, `@import` and `@use` to paths. The
+resolver is shared between the processor and the cache graph so that both
+agree on the same path.
+"""
+
+R = None
+
+# -----------------------------------------------------------------------------
+#
+# RESOLVER
+#
+# -----------------------------------------------------------------------------
+
+class Resolver:
+	"""Resolves a module name to a path by looking first in the directory
+	of the importing file and then in the search paths. Results, including
+	misses, are memoized by `(base, name)` and invalidated when the
+	version (ie. the modification time) of any of the directories that
+	were looked up changes."""
+
+	PATHS = [
+		".",
+		"lib/pcss",
+		"lib/css",
+		"src/pcss",
+		"src/css",
+	]
+
+	EXT = ["", ".pcss", ".css"]
+
+	def __init__( self, paths:Optional[List[str]]=None, exts:Optional[List[str]]=None, source:Optional[Source]=None ):
+		self.paths  = self.PATHS if paths is None else paths
+		self.exts   = self.EXT   if exts  is None else exts
+		self.source = source or getSource()
+		# Maps `(base, name)` to the resolved path (or `None`) and the
+		# `(directory, mtime)` couples that were looked up.
+		self._resolved:Dict[Tuple[Optional[str],str],Tuple[Optional[str],Tuple]] = {}
+
+	def candidates( self, name:str, base:Optional[str]=None ):
+		"""Yields the candidate paths for the given name, in order."""
+		for parent in ([base] if base else []) + self.paths:
+			for ext in self.exts:
+				yield os.path.join(parent, name + ext)
+
+	def resolve( self, name:str, base:Optional[str]=None ) -> Optional[str]:
+		"""Returns the path for the given name resolved from the `base`
+		directory, or `None` if it cannot be resolved."""
+		key    = (base, name)
+		cached = self._resolved.get(key)
+		if cached:
+			path, directories = cached
+			for directory, mtime in directories:
+				if self.source.getDirectoryVersion(directory) != mtime:
+					break
+			else:
+				return path
+		path        = None
+		directories = {}
+		for candidate in self.candidates(name, base):
+			directory = os.path.dirname(candidate) or "."
+			if directory not in directories:
+				directories[directory] = self.source.getDirectoryVersion(directory)
+			if self.source.exists(candidate):
+				path = candidate
+				break
+		self._resolved[key] = (path, tuple(directories.items()))
+		return path
+
+	def clear( self ):
+		self._resolved = {}
+		return self
+
+def getResolver( source:Optional[Source]=None ):
+	"""Returns the shared resolver, or a new resolver when a source other
+	than the default one is given."""
+	global R
+	if source and source is not getSource():
+		return Resolver(source=source)
+	if not R: R = Resolver()
+	return R
+
+# EOF - vim: ts=4 sw=4 noet
@@ -0,0 +1,175 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import os, abc, stat, time, posixpath
+from typing import Optional, Dict, Tuple, Union
+
+__doc__ = """
+Source providers abstract the access to the PCSS sources, so that
+stylesheets can be compiled from the disk or from memory. The grammar
+entry points, the processor's resolution and the cache graph all go
+through a source provider.
+"""
+
+S = None
+
+# -----------------------------------------------------------------------------
+#
+# SOURCE
+#
+# -----------------------------------------------------------------------------
+
+class Source(abc.ABC):
+	"""The interface for source providers, which must implement the
+	abstract methods. Paths are normalized by the provider, and `modified`
+	returns a timestamp that increases each time the content at the given
+	path changes."""
+
+	def normalize( self, path:str ) -> str:
+		return path
+
+	@abc.abstractmethod
+	def exists( self, path:str ) -> bool:
+		pass
+
+	@abc.abstractmethod
+	def read( self, path:str ) -> str:
+		pass
+
+	@abc.abstractmethod
+	def modified( self, path:str ) -> float:
+		pass
+
+	@abc.abstractmethod
+	def getDirectoryVersion( self, path:str ):
+		"""Returns a value that changes when files are added to or
+		removed from the given directory."""
+
+	def parse( self, grammar, path:str ):
+		"""Parses the source at the given path with the given grammar."""
+		return grammar.parseString(self.read(path))
+
+# -----------------------------------------------------------------------------
+#
+# DISK SOURCE
+#
+# -----------------------------------------------------------------------------
+
+class DiskSource(Source):
+	"""Reads the sources from the filesystem, using absolute paths."""
+
+	def normalize( self, path:str ) -> str:
+		return os.path.abspath(path)
+
+	def exists( self, path:str ) -> bool:
+		return os.path.isfile(path)
+
+	def read( self, path:str ) -> str:
+		with open(path) as f:
+			return f.read()
+
+	def modified( self, path:str ) -> float:
+		# OPTIMIZATION. We might want to cache the `stat` and only update
+		# it every 5s or so.
+		return os.stat(path)[stat.ST_MTIME]
+
+	def getDirectoryVersion( self, path:str ) -> Optional[int]:
+		try:
+			return os.stat(path).st_mtime_ns
+		except OSError:
+			return None
+
+	def parse( self, grammar, path:str ):
+		# NOTE: The grammar reads the file directly, which is faster.
+		return grammar.parsePath(path)
+
+# -----------------------------------------------------------------------------
+#
+# MEMORY SOURCE
+#
+# -----------------------------------------------------------------------------
+
+class MemorySource(Source):
+	"""A dict-like source that maps paths to texts, with an optional
+	version. Setting a text with a different version (or without a
+	version) updates its modification time. No disk I/O is done."""
+
+	def __init__( self, files:Optional[Dict[str,Union[str,Tuple[str,object]]]]=None ):
+		# Maps the normalized path to `(text, version, modified)`
+		self.files:Dict[str,Tuple[str,object,float]] = {}
+		# The revision is incremented when a path is added or removed,
+		# and is used as the version of all directories.
+		self.revision = 0
+		self._lastModified = 0.0
+		for path, value in (files or {}).items():
+			if isinstance(value, tuple):
+				self.set(path, *value)
+			else:
+				self.set(path, value)
+
+	def normalize( self, path:str ) -> str:
+		return posixpath.normpath(path)
+
+	def set( self, path:str, text:str, version:object=None ):
+		path     = self.normalize(path)
+		previous = self.files.get(path)
+		if previous and version is not None and previous[1] == version:
+			return self
+		if not previous:
+			self.revision += 1
+		# We make sure that the modification time is always increasing,
+		# so that a change is never missed by the cache.
+		self._lastModified = max(time.time(), self._lastModified + 0.000001)
+		self.files[path] = (text, version, self._lastModified)
+		return self
+
+	def remove( self, path:str ):
+		path = self.normalize(path)
+		if path in self.files:
+			del self.files[path]
+			self.revision += 1
+		return self
+
+	def version( self, path:str ):
+		return self._get(path)[1]
+
+	def exists( self, path:str ) -> bool:
+		return self.normalize(path) in self.files
+
+	def read( self, path:str ) -> str:
+		return self._get(path)[0]
+
+	def modified( self, path:str ) -> float:
+		return self._get(path)[2]
+
+	def getDirectoryVersion( self, path:str ) -> int:
+		return self.revision
+
+	def _get( self, path:str ):
+		path = self.normalize(path)
+		if path not in self.files:
+			raise FileNotFoundError("No source for path: {0}".format(path))
+		return self.files[path]
+
+	def __contains__( self, path:str ) -> bool:
+		return self.exists(path)
+
+	def __getitem__( self, path:str ) -> str:
+		return self.read(path)
+
+	def __setitem__( self, path:str, text:str ):
+		self.set(path, text)
+
+	def __delitem__( self, path:str ):
+		self.remove(path)
+
+def getSource():
+	global S
+	if not S: S = DiskSource()
+	return S
+
+# EOF - vim: ts=4 sw=4 noet
@@ -0,0 +1,134 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import os, re, json, bisect
+from   typing  import Dict,List,Optional
+from  .source  import getSource
+
+__doc__ = """
+Version 3 source maps, which map the positions in the generated CSS back to
+the `.pcss` files. The `CSSWriter` marks the position of each rule and
+declaration as it writes them, and the mappings are encoded as the marks
+come, so that the output doesn't need to be traversed again.
+
+The model elements know the file their offsets refer to (see
+`PCSSProcessor.stampSource`), which is the including file for `@include`d
+elements and the defining file for the expansions of imported macros.
+"""
+
+BASE64     = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+RE_NEWLINE = re.compile(b"\n")
+
+def encodeVLQ( value:int ) -> str:
+	"""Encodes the given integer as a base 64 VLQ."""
+	value = (value << 1) if value >= 0 else ((-value) << 1) | 1
+	res   = []
+	while True:
+		digit   = value & 31
+		value >>= 5
+		if value:
+			res.append(BASE64[digit | 32])
+		else:
+			res.append(BASE64[digit])
+			return "".join(res)
+
+# -----------------------------------------------------------------------------
+#
+# SOURCE MAP
+#
+# -----------------------------------------------------------------------------
+
+class SourceMap:
+	"""Encodes the mappings of the generated positions to the source files.
+	The `source` provider is used to read the files and convert the offsets
+	to lines and columns, and the paths of the sources are made relative to
+	the `root` directory when given, which is usually the directory of the
+	source map."""
+
+	def __init__( self, file:Optional[str]=None, root:Optional[str]=None, source=None ):
+		self.file     = file
+		self.root     = root
+		self.source   = source or getSource()
+		self.sources:List[str]     = []
+		self._indexes:Dict[str,int] = {}
+		# Maps the source paths to the offsets of the start of their lines
+		self._lines:Dict[str,List[int]] = {}
+		self._texts:Dict[str,bytes]     = {}
+		self._mappings:List[str]        = []
+		# The last generated line and the previous values of the segment
+		# fields, as they are encoded relative to the previous segment.
+		self._line     = 0
+		self._previous = [0, 0, 0, 0]
+		self._hasSegment = False
+
+	def mark( self, line:int, column:int, element ) -> bool:
+		"""Maps the given generated line and column to the source position
+		of the given element, returning `False` when the element has no
+		known position."""
+		offset = element._offsets[0]
+		path   = element._source
+		if offset is None or path is None:
+			return False
+		position = self.getPosition(path, offset)
+		if position is None:
+			return False
+		if line > self._line:
+			self._mappings.append(";" * (line - self._line))
+			self._line        = line
+			self._previous[0] = 0
+			self._hasSegment  = False
+		elif self._hasSegment:
+			self._mappings.append(",")
+		index    = self.getIndex(path)
+		segment  = (column, index, position[0], position[1])
+		previous = self._previous
+		self._mappings.append("".join(encodeVLQ(segment[i] - previous[i]) for i in range(4)))
+		self._previous   = list(segment)
+		self._hasSegment = True
+		return True
+
+	def getIndex( self, path:str ) -> int:
+		index = self._indexes.get(path)
+		if index is None:
+			index = self._indexes[path] = len(self.sources)
+			self.sources.append(os.path.relpath(path, self.root) if self.root else path)
+		return index
+
+	def getPosition( self, path:str, offset:int ):
+		"""Returns the zero-based `(line, column)` of the given byte offset
+		in the file at the given path, or `None`."""
+		lines = self._lines.get(path)
+		if lines is None:
+			try:
+				text = self.source.read(path).encode("utf8")
+			except (IOError, OSError, KeyError):
+				text = None
+			lines = self._lines[path] = [0] + [_.end() for _ in RE_NEWLINE.finditer(text)] if text is not None else []
+			self._texts[path] = text
+		if not lines:
+			return None
+		line   = bisect.bisect_right(lines, offset) - 1
+		column = len(self._texts[path][lines[line]:offset].decode("utf8", "replace"))
+		return (line, column)
+
+	def asDict( self ) -> Dict:
+		res = dict(
+			version  = 3,
+			sources  = self.sources,
+			names    = [],
+			mappings = "".join(self._mappings),
+		)
+		if self.file:
+			res["file"] = self.file
+		return res
+
+	def write( self, output ):
+		"""Writes the source map as JSON to the given text output."""
+		json.dump(self.asDict(), output)
+		return output
+
+# EOF - vim: ts=4 sw=4 noet
@@ -0,0 +1,102 @@
+# encoding=utf8 ---------------------------------------------------------------
+# Project           : PythonicCSS
+# -----------------------------------------------------------------------------
+# Author            : FFunction
+# License           : BSD License
+# -----------------------------------------------------------------------------
+
+import io
+from   concurrent.futures import ProcessPoolExecutor
+from   typing       import Dict,List,Optional
+from  .grammar      import getGrammar, parsePath
+from  .processor    import PCSSProcessor
+from  .writer       import CSSWriter
+from  .model        import Variable
+
+__doc__ = """
+Compiles variants (themes) of a stylesheet that only differ by the value of
+some top-level variables. The stylesheet is parsed and processed once, and
+for each theme the overriding variables are inserted at the start of the
+stylesheet, which gives the same result as prepending their definitions to
+the source text, as the first definition of a variable wins.
+"""
+
+# The compiler of the worker processes, see `initWorker`
+WORKER = None
+
+# -----------------------------------------------------------------------------
+#
+# THEME COMPILER
+#
+# -----------------------------------------------------------------------------
+
+class ThemeCompiler:
+	"""Compiles themes of the stylesheet at the given path (or of the given
+	text), where a theme is a mapping of variable names to PCSS values."""
+
+	def __init__( self, path:Optional[str]=None, text:Optional[str]=None, graph=None, minify:bool=False, prefixes=None ):
+		self.path       = path
+		self.text       = text
+		self.graph      = graph
+		self.minify     = minify
+		self.prefixes   = prefixes
+		self.grammar    = getGrammar()
+		self.stylesheet = self.process(self.parse(text, path), path)
+
+	def parse( self, text:Optional[str], path:Optional[str]=None ):
+		result = self.grammar.parseString(text) if text is not None else parsePath(path, self.graph.source if self.graph else None, self.grammar)
+		if not result.isSuccess():
+			raise Exception("Parsing of {0} failed at line:{1}\n> {2}".format(path or "string", result.line, result.describe()))
+		return result
+
+	def process( self, result, path:Optional[str]=None ):
+		return PCSSProcessor(grammar=self.grammar, path=path or ".", graph=self.graph).process(result)
+
+	def createOverrides( self, overrides:Dict[str,str] ) -> List[Variable]:
+		"""Returns the variables defined by the given overrides, as if they
+		were declared at the start of the stylesheet."""
+		text = "".join("{0} = {1}\n".format(k, v) for k, v in overrides.items())
+		return [_ for _ in self.process(self.parse(text), self.path).content if isinstance(_, Variable)]
+
+	def write( self, overrides:Dict[str,str], output ):
+		"""Writes the CSS for the given overrides to the given output."""
+		variables = self.createOverrides(overrides)
+		for i, variable in enumerate(variables):
+			if variable.parent():
+				variable.parent().remove(variable)
+			self.stylesheet.insert(i, variable)
+		try:
+			CSSWriter(output=output, minify=self.minify, prefixes=self.prefixes).write(self.stylesheet)
+		finally:
+			for variable in variables:
+				self.stylesheet.remove(variable)
+		return output
+
+	def compile( self, overrides:Dict[str,str] ) -> bytes:
+		"""Returns the CSS for the given overrides."""
+		return self.write(overrides, io.BytesIO()).getvalue()
+
+	def compileAll( self, themes:Dict[str,Dict[str,str]], processes:Optional[int]=None ) -> Dict[str,bytes]:
+		"""Returns the CSS for each of the given themes. When `processes` is
+		greater than 1, the themes are compiled in a pool of processes that
+		each parse and process the stylesheet once."""
+		if not processes or processes <= 1 or len(themes) <= 1:
+			return dict((name, self.compile(overrides)) for name, overrides in themes.items())
+		names = list(themes.keys())
+		with ProcessPoolExecutor(max_workers=processes, initializer=initWorker, initargs=(self.path, self.text, self.minify, self.prefixes)) as pool:
+			return dict(zip(names, pool.map(compileWorker, [themes[_] for _ in names])))
+
+# -----------------------------------------------------------------------------
+#
+# WORKERS
+#
+# -----------------------------------------------------------------------------
+
+def initWorker( path:Optional[str], text:Optional[str], minify:bool=False, prefixes=None ):
+	global WORKER
+	WORKER = ThemeCompiler(path=path, text=text, minify=minify, prefixes=prefixes)
+
+def compileWorker( overrides:Dict[str,str] ) -> bytes:
+	return WORKER.compile(overrides)
+
+# EOF - vim: ts=4 sw=4 noet
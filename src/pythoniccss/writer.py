@@ -9,7 +9,7 @@
 # -----------------------------------------------------------------------------
 
 from __future__ import print_function
-import sys, types, io, os
+import sys, types, io, os, re
 
 IS_PYTHON3 = sys.version_info.major >= 3
 
@@ -59,6 +59,118 @@ PREFIXES = (
 	"-ms-",
 )
 
+# The vendor prefixes required by each property for the target browsers
+# of a profile, or the prefixes for all the `PREFIXABLE_PROPERTIES`.
+PREFIX_PROFILES = {
+	"all"    : PREFIXES,
+	"modern" : {
+		"appearance"          : ("-webkit-", "-moz-"),
+		"backface-visibility" : ("-webkit-",),
+		"user-select"         : ("-webkit-",),
+	},
+	"none"   : (),
+}
+
+# The CSS named colors that are shorter than the shortest hexadecimal
+# notation of their value, used by the minified output.
+SHORT_COLOR_NAMES = {
+	"#f00"    : "red",
+	"#d2b48c" : "tan",
+	"#f0ffff" : "azure",
+	"#f5f5dc" : "beige",
+	"#ffe4c4" : "bisque",
+	"#a52a2a" : "brown",
+	"#ff7f50" : "coral",
+	"#ffd700" : "gold",
+	"#808080" : "gray",
+	"#008000" : "green",
+	"#4b0082" : "indigo",
+	"#fffff0" : "ivory",
+	"#f0e68c" : "khaki",
+	"#faf0e6" : "linen",
+	"#800000" : "maroon",
+	"#000080" : "navy",
+	"#808000" : "olive",
+	"#ffa500" : "orange",
+	"#da70d6" : "orchid",
+	"#cd853f" : "peru",
+	"#ffc0cb" : "pink",
+	"#dda0dd" : "plum",
+	"#800080" : "purple",
+	"#fa8072" : "salmon",
+	"#a0522d" : "sienna",
+	"#c0c0c0" : "silver",
+	"#fffafa" : "snow",
+	"#008080" : "teal",
+	"#ff6347" : "tomato",
+	"#ee82ee" : "violet",
+	"#f5deb3" : "wheat",
+}
+
+# The length units, which can be omitted when the value is zero
+LENGTH_UNITS = (
+	"px", "em", "rem", "ex", "ch", "vw", "vh", "vmin", "vmax",
+	"cm", "mm", "q", "in", "pt", "pc",
+)
+
+# The properties where a zero length keeps its unit in the minified output,
+# as a unitless zero means something else: `flex: 1 0px` has a zero basis,
+# while `flex: 1 0` has a zero shrink factor.
+UNIT_ZERO_PROPERTIES = (
+	"flex",
+	"flex-basis",
+)
+
+# The whitespace around combinators, removed from the selectors in the
+# minified output (when they don't contain attributes, strings or parens).
+RE_COMBINATOR = re.compile(r"\s*([>+~])\s*")
+
+# The size of the encoded chunks produced by `CSSWriter.chunks`
+CHUNK_SIZE = 64 * 1024
+
+# -----------------------------------------------------------------------------
+#
+# PREFIX POLICY
+#
+# -----------------------------------------------------------------------------
+
+class PrefixPolicy( object ):
+	"""Defines the names under which each property is written. The `profile`
+	is either the name of one of the `PREFIX_PROFILES`, a mapping of property
+	names to their vendor prefixes, or prefixes that apply to all the
+	`PREFIXABLE_PROPERTIES`. The unprefixed name is always written first,
+	and the prefixed names go through `PREFIXABLE_PROPERTIES_OVERRIDES`."""
+
+	def __init__( self, profile="all" ):
+		prefixes = PREFIX_PROFILES[profile] if isinstance(profile, str) else profile
+		if not isinstance(prefixes, dict):
+			prefixes = dict((_, prefixes) for _ in PREFIXABLE_PROPERTIES)
+		self.profile = profile
+		# The names are precomputed, so that the writer only does a lookup
+		self.names   = {}
+		for name, values in prefixes.items():
+			names = [name]
+			for prefix in values:
+				prefixed = PREFIXABLE_PROPERTIES_OVERRIDES.get(prefix + name, prefix + name)
+				if prefixed not in names:
+					names.append(prefixed)
+			if len(names) > 1:
+				self.names[name] = tuple(names)
+
+	def getNames( self, name ):
+		"""Returns the names under which the given property is written."""
+		return self.names.get(name) or (name,)
+
+# The default policy, which writes all the prefixes
+PREFIX_POLICY = PrefixPolicy()
+
+class SourceMark( object ):
+	"""Marks the position of the given element in the output, when the
+	writer has a source map."""
+
+	def __init__( self, element ):
+		self.element = element
+
 # -----------------------------------------------------------------------------
 #
 # CSS WRITER
@@ -66,55 +178,105 @@ PREFIXES = (
 # -----------------------------------------------------------------------------
 
 class CSSWriter( object ):
-
-	def __init__( self, output=sys.stdout ):
+	"""Writes the CSS for a PCSS model. When `minify` is true, the output
+	has no optional whitespace or semicolon, and colors and numbers are
+	written in their shortest form. When a `sourceMap` is given, the
+	position of each rule and declaration is mapped to its source. The
+	`prefixes` are a `PrefixPolicy` or the name of a profile, and `imports`
+	maps the paths of imported stylesheets to the URLs of their CSS.
+
+	The output is streamed: `iterate` walks the generators of the handlers
+	without recursion, `chunks` encodes it in fixed-size chunks (which can
+	be returned as a WSGI response body) and `writeTo` writes the chunks to
+	a binary sink, so that the CSS is never held whole in memory."""
+
+	def __init__( self, output=sys.stdout, minify=False, sourceMap=None, prefixes=None, imports=None ):
+		self.imports    = imports
 		self.output     = output
+		self.minify     = minify
+		self.sourceMap  = sourceMap
+		self.prefixes   = PREFIX_POLICY if prefixes is None else prefixes if isinstance(prefixes, PrefixPolicy) else PrefixPolicy(prefixes)
+		# The current line and column in the output, which are only
+		# tracked when there is a source map.
+		self.line       = 0
+		self.column     = 0
 		self.isOpen     = None
 		self._namespace = None
 		self._selectors = []
+		# The number of declarations written in the current rule, used to
+		# separate them in the minified output.
+		self._declarations = 0
+		# The name of the property whose value is being written, and the
+		# number of function invocations the value is in, as a zero length
+		# keeps its unit in some properties and in functions like `calc()`.
+		self._property     = None
+		self._functions    = 0
 
 	def write( self, element ):
-		self._namespace = self
-		self._selectors = {}
-		for _ in self.on(element):
-			self._write(_)
+		if isinstance(self.output, io.TextIOBase):
+			for _ in self.iterate(element):
+				self.output.write(_)
+		else:
+			self.writeTo(element, self.output)
 		self.output.flush()
 
-	def _write( self, value ):
-		# NOTE: In Python2 and Python3 sys.std{out,err} don't have the same
-		# type. They're binary/str in Python2 and unicode/str in Python3
-		if isinstance(self.output, io.TextIOBase):
-			self._writeUnicode(value)
+	def writeTo( self, element, sink, size=CHUNK_SIZE ):
+		"""Writes the CSS for the given element to the given binary sink
+		(a file, a socket file or a gzip stream) in chunks of the given
+		size, returning the number of bytes written."""
+		res = 0
+		for _ in self.chunks(element, size):
+			sink.write(_)
+			res += len(_)
+		return res
+
+	def chunks( self, element, size=CHUNK_SIZE ):
+		"""Yields the UTF-8 encoded CSS for the given element in chunks of
+		the given size (the last one being shorter)."""
+		buffer = bytearray()
+		for _ in self.iterate(element):
+			buffer += _.encode("utf-8")
+			if len(buffer) >= size:
+				offset = 0
+				while len(buffer) - offset >= size:
+					yield bytes(buffer[offset:offset + size])
+					offset += size
+				del buffer[:offset]
+		if buffer:
+			yield bytes(buffer)
+
+	def iterate( self, element ):
+		"""Yields the strings of the CSS for the given element, in order.
+		The nested generators returned by the handlers are walked with a
+		stack, like in `flatten`, and the source marks are consumed."""
+		self._namespace = self
+		self._selectors = {}
+		values = [self.on(element)]
+		while values:
+			_ = next(values[-1], NOTHING)
+			if _ is NOTHING:
+				values.pop()
+			elif isinstance(_, types.GeneratorType) or isinstance(_, list) or isinstance(_, tuple):
+				values.append(iter(_))
+			elif isinstance(_, SourceMark):
+				self.sourceMap.mark(self.line, self.column, _.element)
+			elif _:
+				if isinstance(_, bytes):
+					_ = _.decode("utf-8")
+				elif not isinstance(_, str):
+					raise ValueError("Does not know how to write value: `{0}`".format(repr(_)))
+				if self.sourceMap is not None:
+					self._advance(_)
+				yield _
+
+	def _advance( self, text ):
+		"""Updates the position in the output after the given text."""
+		lines = text.count("\n")
+		if lines:
+			self.line  += lines
+			self.column = len(text) - text.rindex("\n") - 1
 		else:
-			self._writeBinary(value)
-
-	def _writeUnicode( self, value ):
-		if isinstance(value, types.GeneratorType) or isinstance(value, list) or isinstance(value, tuple):
-			for _ in value: self._writeUnicode(_)
-		elif IS_PYTHON3 and isinstance(value, str):
-			self.output.write(value)
-		elif not IS_PYTHON3 and isinstance(value, unicode):
-			self.output.write(value)
-		elif isinstance(value, bytes):
-			self.output.write(value.decode("utf-8"))
-		elif not IS_PYTHON3 and isinstance(value, str):
-			self.output.write(value.decode("utf-8"))
-		elif value:
-			raise ValueError("Does not know how to write value: `{0}`".format(repr(value)))
-
-	def _writeBinary( self, value ):
-		if isinstance(value, types.GeneratorType) or isinstance(value, list) or isinstance(value, tuple):
-			for _ in value: self._writeBinary(_)
-		elif IS_PYTHON3 and isinstance(value, str):
-			self.output.write(value.encode("utf-8"))
-		elif not IS_PYTHON3 and isinstance(value, unicode):
-			self.output.write(value.encode("utf-8"))
-		elif isinstance(value, bytes):
-			self.output.write(value)
-		elif not IS_PYTHON3 and isinstance(value, str):
-			self.output.write(value)
-		elif value:
-			raise ValueError("Does not know how to write value: `{0}`".format(repr(value)))
+			self.column += len(text)
 
 	def on( self, element ):
 		if isinstance(element, Comment):
@@ -143,6 +305,8 @@ class CSSWriter( object ):
 			yield self.onMethodInvocation(element)
 		elif isinstance(element, Property):
 			yield self.onProperty(element)
+		elif isinstance(element, Verbatim):
+			yield self.onVerbatim(element)
 		elif isinstance(element, Selector):
 			yield self.onSelector(element)
 		elif isinstance(element, String):
@@ -176,32 +340,44 @@ class CSSWriter( object ):
 
 	def onStylesheet( self, element ):
 		for _ in element.content:
-			yield self.write(_)
+			yield self.on(_)
 		yield "}" if self.isOpen else ""
 
 	def onBlock( self, element ):
 		# Here we only output the selectors if we know we have one
 		# direct child with significant output.
 		has_content = next((_ for _ in element.content if isinstance(_, Output)), False)
-		for s in element.selectors():
-			self._selectors[s.expr(namespace=False)] = element
-		if has_content:
+		for s in element.selectorExpressions(namespace=False):
+			self._selectors[s] = element
+		if has_content and self.minify:
+			if self.isOpen:
+				yield "}"
+				self.isOpen = False
+			if self.sourceMap is not None: yield SourceMark(element)
+			yield ",".join(self.minifySelector(_) for _ in element.selectorExpressions())
+		elif has_content:
 			if self.isOpen:
 				yield "}\n"
 				self.isOpen = False
-			sel = element.selectors()
+			# NOTE: The selectors are written from their cached expressions,
+			# so that no selector object is created.
+			sel = element.selectorExpressions()
 			l = len(sel) - 1
 			for i,_ in enumerate(sel):
 				if i == 0:
 					yield "\n"
-				yield self.on(_)
+					if self.sourceMap is not None: yield SourceMark(element)
+				yield _
 				if i < l:
 					yield ",\n"
 		if has_content:
-			yield " {\n"
+			yield "{" if self.minify else " {\n"
 			self.isOpen = True
+			self._declarations = 0
 		for _ in element.getUniqueContent():
 			yield self.on(_)
+		# The child blocks are written, so their prefixes are not needed
+		element.releasePrefixes()
 
 	def onContext( self, element ):
 		for _ in element.content:
@@ -217,7 +393,9 @@ class CSSWriter( object ):
 		value = element.value
 		yield name
 		yield "("
+		self._functions += 1
 		yield self.on(element.arguments)
+		self._functions -= 1
 		yield ")"
 
 	def onMethodInvocation( self, element ):
@@ -225,27 +403,70 @@ class CSSWriter( object ):
 			yield _
 
 	def onProperty( self, element ):
-		name  = element.name
-		value = element.value
-		lines = ((p, name, value) for p in PREFIXES) if name in PREFIXABLE_PROPERTIES else ((None, name, value),)
-		for p, n, value in lines:
-			yield "  "
-			if p: yield p
-			yield n
-			yield ": "
-			if element.value:
-				assert isinstance(element.value, Node) or isinstance(element.value, Leaf), "Value neither node or leaf: {0} in {1}".format(element.value, self)
-				yield self.on(element.value)
-			if element.important:
-				yield "important"
-			yield ";\n"
+		names = self.prefixes.getNames(element.name)
+		# NOTE: The value is only written once when there are prefixes
+		value = self.flatten(self.onValue(element)) if len(names) > 1 else None
+		for name in names:
+			if self.minify:
+				# NOTE: Declarations are separated, so that the last one
+				# has no semicolon.
+				if self._declarations: yield ";"
+			else:
+				yield "  "
+			self._declarations += 1
+			if self.sourceMap is not None: yield SourceMark(element)
+			yield self.onDeclaration(element, name, value)
+			if not self.minify:
+				yield ";\n"
+
+	def onVerbatim( self, element ):
+		"""Writes the text of the element as-is, after closing the current
+		rule."""
+		if self.isOpen:
+			yield "}" if self.minify else "}\n"
+			self.isOpen = False
+		if not self.minify:
+			yield "\n"
+		if self.sourceMap is not None: yield SourceMark(element)
+		yield element.value
+
+	def onDeclaration( self, element, name=None, value=None ):
+		"""Writes the declaration of the given property under the given
+		(prefixed) name, without indentation or separator. The value is
+		written unless it is given."""
+		yield name or element.name
+		yield ":" if self.minify else ": "
+		yield self.onValue(element) if value is None else value
+
+	def onValue( self, element ):
+		self._property = element.name if isinstance(element, Property) else None
+		if element.value:
+			assert isinstance(element.value, Node) or isinstance(element.value, Leaf), "Value neither node or leaf: {0} in {1}".format(element.value, self)
+			yield self.on(element.value)
+		if element.important:
+			yield "important"
+
+	def flatten( self, value ):
+		"""Returns the list of strings produced by the given (nested)
+		generator output."""
+		res    = []
+		values = [iter((value,))]
+		while values:
+			_ = next(values[-1], NOTHING)
+			if _ is NOTHING:
+				values.pop()
+			elif isinstance(_, types.GeneratorType) or isinstance(_, list) or isinstance(_, tuple):
+				values.append(iter(_))
+			elif _:
+				res.append(_)
+		return res
 
 	def onComputation( self, element ):
 		yield self.on(element.eval())
 
 	def onList( self, element ):
 		last = len(element.value) - 1
-		sep  = (element.separator or "") + " "
+		sep  = (element.separator or " ") if self.minify else (element.separator or "") + " "
 		for i,_ in enumerate(element.value):
 			yield self.on(_)
 			if i < last:
@@ -260,24 +481,40 @@ class CSSWriter( object ):
 
 	def onRGB( self, element ):
 		r,g,b = element.value
-		yield ("#{0:02X}{1:02X}{2:02X}".format(int(r), int(g), int(b)))
+		if self.minify:
+			yield self.minifyColor("#{0:02x}{1:02x}{2:02x}".format(int(r), int(g), int(b)))
+		else:
+			yield ("#{0:02X}{1:02X}{2:02X}".format(int(r), int(g), int(b)))
 
 	def onRGBA( self, element ):
 		r,g,b,a = element.value
-		yield ("rgba({0:d},{1:d},{2:d},{3:0.2f})".format(int(r), int(g), int(b), a))
+		if self.minify:
+			yield ("rgba({0:d},{1:d},{2:d},{3})".format(int(r), int(g), int(b), self.minifyNumber("{0:0.2f}".format(a))))
+		else:
+			yield ("rgba({0:d},{1:d},{2:d},{3:0.2f})".format(int(r), int(g), int(b), a))
 
 	def onNumber( self, element ):
 		element = element.eval()
 		value   = element.value
+		unit    = element.unit or ""
 		if element.unit == "%":
 			value = value * 100
 		if value == int(value):
 			value = int(value)
-			yield "{0:d}{1}".format(value, element.unit or "")
+			if self.minify and value == 0 and self.canDropUnit(unit):
+				unit = ""
+			yield "{0:d}{1}".format(value, unit)
 		else:
-			value = "{0:0.3f}".format(value)
-			while value[-1] in "0.": value = value[:-1]
-			yield "{0}{1}".format(value, element.unit or "")
+			# NOTE: Only the trailing zeros of the decimals are removed, and
+			# values that round to zero are written as `0`, without sign.
+			value = "{0:0.3f}".format(value).rstrip("0").rstrip(".")
+			if value == "-0":
+				value = "0"
+			if self.minify:
+				value = self.minifyNumber(value)
+				if value == "0" and self.canDropUnit(unit):
+					unit = ""
+			yield "{0}{1}".format(value, unit)
 
 	def onRawString( self, element ):
 		yield (element.value)
@@ -301,31 +538,41 @@ class CSSWriter( object ):
 		yield "url(" + url_path + ")"
 
 	def onKeyframes( self, element ):
+		if self.sourceMap is not None: yield SourceMark(element)
 		yield ("@keyframes ")
 		yield (element.name)
-		yield (" {\n")
+		yield ("{" if self.minify else " {\n")
 		for _ in element.content:
 			yield self.on(_)
-		yield ("}\n")
+		yield ("}" if self.minify else "}\n")
 
 	def onKeyframe( self, element ):
-		yield ("\t")
+		if not self.minify: yield ("\t")
 		if element.selector.value == 100 and element.selector.unit == "%":
 			yield ("to")
 		elif element.selector.value == 0 and element.selector.unit == "%":
 			yield ("from")
 		else:
 			yield self.on(element.selector)
-		yield (" {\n")
+		yield ("{" if self.minify else " {\n")
+		self._declarations = 0
 		for _ in element.content:
-			yield ("\t")
+			if not self.minify: yield ("\t")
 			yield self.on(_)
-		yield ("\t}\n")
+		yield ("}" if self.minify else "\t}\n")
 
 	def onImportDirective( self, element ):
 		# We don't output imports for now
 		path   = element.path
 		source = element.value
+		if self.isOpen:
+			# The directive closes the block written before it
+			yield "}" if self.minify else "}\n"
+			self.isOpen = False
+		if self.imports and element.stylesheet is not None and element.stylesheet.path in self.imports:
+			# The imported stylesheet is written under another name
+			yield "@import url(\"{0}\");".format(self.imports[element.stylesheet.path])
+			return
 		if not path:
 			if isinstance(source, URL):
 				path = source.value
@@ -338,6 +585,41 @@ class CSSWriter( object ):
 		# NOTE: We don't need to do anything
 		pass
 
+	# =========================================================================
+	# MINIFICATION
+	# =========================================================================
+
+	def minifyColor( self, color ):
+		"""Returns the shortest notation for the given lowercase `#rrggbb`
+		color."""
+		if color[1] == color[2] and color[3] == color[4] and color[5] == color[6]:
+			color = "#" + color[1] + color[3] + color[5]
+		return SHORT_COLOR_NAMES.get(color, color)
+
+	def minifyNumber( self, value ):
+		"""Removes the leading zero and the trailing zeros of the given
+		formatted number."""
+		if "." in value:
+			value = value.rstrip("0").rstrip(".") or "0"
+		if value.startswith("0."):
+			value = value[1:]
+		elif value.startswith("-0."):
+			value = "-" + value[2:]
+		return value
+
+	def canDropUnit( self, unit ):
+		"""Tells if the given unit can be omitted from a zero in the
+		current value."""
+		return unit in LENGTH_UNITS and not self._functions and self._property not in UNIT_ZERO_PROPERTIES
+
+	def minifySelector( self, selector ):
+		"""Removes the whitespace around combinators, unless the selector
+		has attributes, strings or parens that could contain them."""
+		for _ in "[(\"'":
+			if _ in selector:
+				return selector
+		return RE_COMBINATOR.sub(r"\1", selector)
+
 	def _findSelector( self, element, selector, block=None ):
 		s = self._selectors.get(selector)
 		if not s or s is block: